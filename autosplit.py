@@ -1,10 +1,18 @@
 #!/usr/bin/env python
 # authored 2024 by Michael 'v4hn' Goerner
 
+from buildtimes import BuildTimes
+from simulate import Runners, cheapest, simulate, stage_options
 from workspace import Workspace
+from dataclasses import dataclass
 from typing import Dict, Set, List, NamedTuple
-from copy import deepcopy
+import argparse
+import heapq
+import itertools
+import json
+import math
 import numpy as np
+import profiling
 import sys
 
 SBUILD_OPTIONS = {
@@ -15,98 +23,441 @@ SBUILD_OPTIONS = {
     "pinocchio": ""
 }
 
+# sbuild options of workers whose parallelism is derived from a MemoryProfile
+SBUILD_JOBS = "$dpkg_buildpackage_user_options = ['--jobs={}'];"
+
+class MemoryProfile:
+    '''
+    peak memory (MB) of past sbuild runs per repository together with the number of parallel jobs of these runs
+
+    Read from json as {"<repository>": {"memory": <peak MB>, "jobs": <parallel jobs>}}.
+    '''
+    def __init__(self, filename):
+        with open(filename) as f:
+            self.profile = json.load(f)
+
+    def sbuild_jobs(self, repository, runner_memory, runner_cores) -> int:
+        '''
+        number of parallel jobs the repository can be built with on a runner without running out of memory
+        '''
+        p = self.profile.get(repository)
+        if not p or not p.get('memory', 0) > 0:
+            # nothing known about the memory use, the build is unconstrained
+            return runner_cores
+        per_job = p['memory'] / (p.get('jobs') or runner_cores)
+        return max(1, min(runner_cores, int(runner_memory // per_job)))
+
 def stages(ws):
-    ws = deepcopy(ws)
-    while ws.repositories:
-        if "setup_files" in ws.repositories or "ros_environment" in ws.repositories:
-            # these two are special because they are needed for the build environment
-            stage = [ws.repositories["setup_files"], ws.repositories["ros_environment"]]
-        else:
-            # find all repositories without build dependencies
-            stage = [r for r in ws.repositories.values()
-                     if not r.build_depends and not r.test_depends and not r.exec_depends
-                     and (not r.bonded or not any(ws.repositories[br].build_depends.union(ws.repositories[br].test_depends, ws.repositories[br].exec_depends) for br in r.bonded))]
+    '''
+    yields lists of repositories which can be built in parallel once all previous stages are built
 
-        if not stage:
-            print("ERROR: unbonded cyclic dependencies detected. Remaining repositories:", file=sys.stderr)
-            for r in ws.repositories.values():
-                print(f"{r.name}: {r.build_depends} / {r.test_depends} / {r.exec_depends}", file=sys.stderr)
-            return
+    Kahn's algorithm over the bonded groups in ws.condensation with in-degree counters,
+    so all stages together cost O(V+E) and the workspace is not modified.
+    '''
+    cond = ws.condensation
+    groups = [ws.group(c) for c in range(len(cond))]
+    alive = np.array([bool(g) for g in groups])
 
-        yield stage
+    # number of dependencies of each group which are not built yet
+    src = np.repeat(np.arange(len(cond)), np.diff(cond.indptr))
+    live = alive[src] & alive[cond.indices]
+    pending = np.bincount(src[live], minlength=len(cond)).tolist()
+    rindptr, rindices = cond.rindptr.tolist(), cond.rindices.tolist()
+    done = [not a for a in alive]
 
-        for r in stage:
-            ws.drop_repository(r.name)
+    def complete(stage):
+        '''
+        mark groups in stage as built and return the groups which became buildable
+        '''
+        for c in stage:
+            done[c] = True
+        ready = []
+        for c in stage:
+            for d in rindices[rindptr[c]:rindptr[c+1]]:
+                pending[d] -= 1
+                if pending[d] == 0 and not done[d]:
+                    ready.append(d)
+        return ready
 
-def assign_tasks_to_workers(costs: Dict[str, int], max_workers: int) -> List[List[str]]:
+    # these two are special because they are needed for the build environment
+    special = sorted(set(cond.component[ws.repositories[r].id] for r in ("setup_files", "ros_environment") if r in ws.repositories))
+    if special:
+        yield [r for c in special for r in groups[c]]
+        complete(special)
+
+    # all groups without unbuilt dependencies
+    stage = [c for c in range(len(cond)) if not done[c] and pending[c] == 0]
+    while stage:
+        stage.sort()
+        yield [r for c in stage for r in groups[c]]
+        stage = [c for c in complete(stage) if not done[c]]
+
+@dataclass
+class Job:
+    name: str
+    stage: int
+    repositories: List[str]
+    packages: int
+    sbuild_options: str = None
+    # names of the jobs building dependencies, only set for dag scheduling
+    needs: List[str] = None
+
+def nr_of_workers(environment=True):
     '''
-    Assign tasks to workers by minimizing number of workers and filling all actually used workers to the maximum cost of any worker.
+    defines the number of workers to use for each stage in a generator
+    environment: whether the first stage builds the build environment (setup_files/ros_environment)
     '''
-    # sort tasks by cost
-    tasks = sorted(costs, key=lambda t: costs[t], reverse=True)
+    if environment:
+        yield 1 # built requirements cannot be parallelized
+    #yield 10 # the first stage contains many independent packages, but eigenpy/ompl delay it anyway
+    while True: # do not excessively parallelize (though github allows 20 and possibly throttles)
+        #yield 5
+        yield 10
+
+class Packing(NamedTuple):
+    workers: List[List[str]]
+    makespan: float
+    # no assignment to max_workers workers can have a smaller makespan
+    lower_bound: float
+    # parallel sbuild jobs of each worker, only set by pack_memory
+    jobs: List[int] = None
+
+    @property
+    def gap(self):
+        '''
+        relative distance of the makespan to the lower bound
+        '''
+        return self.makespan / self.lower_bound - 1 if self.lower_bound else 0.0
 
-    # initialize workers
+# instances with at most this many tasks are solved exactly
+EXACT_TASKS = 10
+# the exact search gives up after visiting this many nodes and keeps the best assignment found so far
+EXACT_NODES = 100000
+
+def lower_bound(costs: Dict[str, float], max_workers: int) -> float:
+    c = sorted(costs.values(), reverse=True)
+    if not c:
+        return 0
+    bound = max(c[0], sum(c) / max_workers)
+    if len(c) > max_workers:
+        # two of the max_workers+1 largest tasks have to share a worker
+        bound = max(bound, c[max_workers-1] + c[max_workers])
+    return bound
+
+def lpt(costs: Dict[str, float], max_workers: int) -> List[List[str]]:
+    '''
+    longest processing time first: each task goes to the least loaded worker, O(T log W)
+    '''
     workers = [[] for _ in range(max_workers)]
+    heap = [(0, w) for w in range(max_workers)]
+    for task in sorted(costs, key=lambda t: costs[t], reverse=True):
+        load, w = heapq.heappop(heap)
+        workers[w].append(task)
+        heapq.heappush(heap, (load + costs[task], w))
+    return workers
 
-    # assign tasks to workers
-    for task in tasks:
-        # sort workers by cost
-        workers = sorted(workers, key=lambda w: sum(costs[t] for t in w), reverse=True)
-        # try to fit task into a worker starting from the most loaded one
-        for worker in workers:
-            if sum(costs[t] for t in worker) + costs[task] <= sum(costs[t] for t in workers[0]):
-                worker.append(task)
+def improve(workers: List[List[str]], costs: Dict[str, float]) -> List[List[str]]:
+    '''
+    local search moving or swapping tasks of the most loaded worker while this reduces its load
+    Every step reduces the sum of squared loads, the number of steps is bounded nevertheless.
+    '''
+    loads = [sum(costs[t] for t in w) for w in workers]
+    for _ in range(10 * sum(len(w) for w in workers)):
+        a = max(range(len(workers)), key=loads.__getitem__)
+        # ignore improvements in the range of rounding errors
+        limit = loads[a] * (1 - 1e-9)
+        b = min(range(len(workers)), key=loads.__getitem__)
+        for t in workers[a]:
+            if loads[b] + costs[t] < limit:
+                workers[a].remove(t)
+                workers[b].append(t)
+                loads[a] -= costs[t]
+                loads[b] += costs[t]
+                break
+            swap = next(((b, u) for b in range(len(workers)) if b != a for u in workers[b]
+                         if costs[u] < costs[t] and loads[b] + costs[t] - costs[u] < limit), None)
+            if swap:
+                b, u = swap
+                workers[a][workers[a].index(t)] = u
+                workers[b][workers[b].index(u)] = t
+                loads[a] += costs[u] - costs[t]
+                loads[b] += costs[t] - costs[u]
                 break
         else:
-            # if no worker can take the task, use least-loaded one
-            workers[-1].append(task)
+            break
+    return workers
+
+def exact(costs: Dict[str, float], max_workers: int, upper_bound: float, lower_bound: float = 0, max_nodes: int = EXACT_NODES) -> List[List[str]]:
+    '''
+    branch and bound for a minimal makespan assignment, returns None if none is below upper_bound
+    The search stops after max_nodes nodes with the best assignment found so far (or None).
+    '''
+    tasks = sorted(costs, key=lambda t: costs[t], reverse=True)
+    loads = [0] * max_workers
+    assignment = [0] * len(tasks)
+    best = [upper_bound, None]
+    nodes = [0]
 
+    def search(i, used):
+        nodes[0] += 1
+        if nodes[0] > max_nodes:
+            return True
+        if i == len(tasks):
+            best[0] = max(loads)
+            best[1] = list(assignment)
+            return best[0] <= lower_bound
+        seen = set()
+        # a new worker is only opened as the first empty one (symmetry)
+        for w in range(min(used + 1, max_workers)):
+            if loads[w] in seen or loads[w] + costs[tasks[i]] >= best[0]:
+                continue
+            seen.add(loads[w])
+            loads[w] += costs[tasks[i]]
+            assignment[i] = w
+            done = search(i + 1, max(used, w + 1))
+            loads[w] -= costs[tasks[i]]
+            if done:
+                return True
+        return False
+
+    search(0, 0)
+    if best[1] is None:
+        return None
+    workers = [[] for _ in range(max_workers)]
+    for t, w in zip(tasks, best[1]):
+        workers[w].append(t)
     return workers
 
-if __name__ == '__main__':
-    ws = Workspace(sys.argv[1] if len(sys.argv) > 1 else ".")
+def fewest_workers(costs: Dict[str, float], makespan: float, max_workers: int) -> List[List[str]]:
+    '''
+    first fit decreasing into as few workers as possible without exceeding makespan, None if FFD needs max_workers
+    '''
+    total = sum(costs.values())
+    tasks = sorted(costs, key=lambda t: costs[t], reverse=True)
+    for k in range(max(1, math.ceil(total / makespan - 1e-9)), max_workers):
+        workers = [[] for _ in range(k)]
+        loads = [0] * k
+        for t in tasks:
+            w = next((w for w in range(k) if loads[w] + costs[t] <= makespan + 1e-9), None)
+            if w is None:
+                break
+            workers[w].append(t)
+            loads[w] += costs[t]
+        else:
+            return workers
+    return None
 
-    def nr_of_workers():
-        '''
-        defines the number of workers to use for each stage in a generator
-        '''
-        yield 1 # built requirements cannot be parallelized
-        #yield 10 # the first stage contains many independent packages, but eigenpy/ompl delay it anyway
-        while True: # do not excessively parallelize (though github allows 20 and possibly throttles)
-            #yield 5
-            yield 10
+def pack(costs: Dict[str, float], max_workers: int, optimize: bool = True) -> Packing:
+    '''
+    Assign tasks to at most max_workers workers minimizing the makespan first and the number of used workers second.
+
+    LPT assignment, improved by local search (or solved exactly for small instances) when optimize is set,
+    then compacted to the fewest workers which keep the makespan.
+    '''
+    max_workers = max(1, min(max_workers, len(costs)))
+    bound = lower_bound(costs, max_workers)
+    workers = lpt(costs, max_workers)
+    if optimize:
+        workers = improve(workers, costs)
+        makespan = max(sum(costs[t] for t in w) for w in workers)
+        if len(costs) <= EXACT_TASKS and makespan > bound:
+            workers = exact(costs, max_workers, makespan, bound) or workers
+    makespan = max((sum(costs[t] for t in w) for w in workers), default=0)
+
+    if costs and makespan > 0:
+        workers = fewest_workers(costs, makespan, len([w for w in workers if w])) or workers
+    workers = sorted([w for w in workers if w], key=lambda w: sum(costs[t] for t in w), reverse=True)
+    return Packing(workers, makespan, bound)
+
+def relabel(workers: List[List[str]], costs: Dict[str, float], previous: Dict[str, int], labels: List[int] = ()) -> List[int]:
+    '''
+    distinct labels for workers, giving each worker the previous label of as much of its cost as possible
+    labels: labels which are taken already
+    '''
+    overlap = {}
+    for w, worker in enumerate(workers):
+        for t in worker:
+            if t in previous:
+                overlap[(w, previous[t])] = overlap.get((w, previous[t]), 0) + costs[t]
+    taken = set(labels)
+    result = [None] * len(workers)
+    for (w, label), _ in sorted(overlap.items(), key=lambda o: -o[1]):
+        if result[w] is None and label not in taken:
+            result[w] = label
+            taken.add(label)
+    fresh = (l for l in itertools.count() if l not in taken)
+    return [l if l is not None else next(fresh) for l in result]
+
+def pack_stable(costs: Dict[str, float], max_workers: int, previous: Dict[str, int], tolerance: float, reserved: Set[int] = frozenset()):
+    '''
+    Assign tasks to at most max_workers labeled workers, keeping tasks on the worker with their previous label
+    as long as the makespan stays within tolerance (e.g. 0.05) of the one of pack().
+
+    previous: label of the worker each task was assigned to before, labels in reserved are not used
+    Tasks keep their label largest first while they fit below the makespan limit, the others are placed
+    best fit (on the most loaded worker they fit on). If this exceeds the limit, the workers of pack()
+    are labeled to keep as much as possible instead.
+    returns (Packing, label of each worker)
+    '''
+    packing = pack(costs, max_workers)
+    limit = packing.makespan * (1 + tolerance) + 1e-9
+    max_workers = max(1, min(max_workers, len(costs)))
+
+    # the labels which held most of the cost before
+    held = {}
+    for t, label in previous.items():
+        if t in costs and label not in reserved:
+            held[label] = held.get(label, 0) + costs[t]
+    labels = sorted(held, key=lambda l: -held[l])[:max_workers]
+    fresh = (l for l in itertools.count() if l not in held and l not in reserved)
+    labels += [next(fresh) for _ in range(max_workers - len(labels))]
+    slot = {l: i for i, l in enumerate(labels)}
+
+    workers = [[] for _ in labels]
+    loads = [0] * len(labels)
+    free = []
+    for t in sorted(costs, key=lambda t: costs[t], reverse=True):
+        w = slot.get(previous.get(t))
+        if w is not None and loads[w] + costs[t] <= limit:
+            workers[w].append(t)
+            loads[w] += costs[t]
+        else:
+            free.append(t)
+    for t in free:
+        fits = [w for w in range(len(labels)) if loads[w] + costs[t] <= limit]
+        w = max(fits, key=loads.__getitem__) if fits else min(range(len(labels)), key=loads.__getitem__)
+        workers[w].append(t)
+        loads[w] += costs[t]
+
+    if max(loads, default=0) > limit:
+        return packing, relabel(packing.workers, costs, previous, reserved)
+    used = sorted((w for w in range(len(labels)) if workers[w]), key=lambda w: loads[w], reverse=True)
+    return Packing([workers[w] for w in used], max(loads, default=0), packing.lower_bound), [labels[w] for w in used]
+
+def pack_memory(costs: Dict[str, float], jobs: Dict[str, int], max_workers: int) -> Packing:
+    '''
+    Assign tasks to at most max_workers workers under a memory cap and minimizing the makespan.
+
+    jobs are the parallel sbuild jobs each task can run with without exceeding the memory of a runner
+    and costs are the build times with this parallelism.
+    A worker builds all its tasks with the smallest parallelism of any of them, which keeps it below the memory cap,
+    and the other tasks slow down proportionally.
+    Tasks are placed memory-heavy (least parallelism) first and largest first within the same parallelism,
+    each to the worker with the smallest load after adding it,
+    so memory-heavy tasks are grouped instead of throttling other workers.
+    '''
+    if len(set(jobs.values())) <= 1:
+        # without memory-heavy tasks this is plain makespan packing
+        packing = pack(costs, max_workers)
+        return packing._replace(jobs=[next(iter(jobs.values()), 1)] * len(packing.workers))
+
+    max_workers = max(1, min(max_workers, len(costs)))
+    workers = [[] for _ in range(max_workers)]
+    # load of a worker is work / parallelism, work is the sum of cost * jobs of its tasks
+    work = [0] * max_workers
+    parallelism = [max(jobs.values(), default=1)] * max_workers
+    for t in sorted(costs, key=lambda t: (jobs[t], -costs[t])):
+        w = min(range(max_workers),
+                key=lambda w: ((work[w] + costs[t] * jobs[t]) / min(parallelism[w], jobs[t]), parallelism[w] - min(parallelism[w], jobs[t])))
+        workers[w].append(t)
+        work[w] += costs[t] * jobs[t]
+        parallelism[w] = min(parallelism[w], jobs[t])
+
+    used = [w for w in range(max_workers) if workers[w]]
+    used.sort(key=lambda w: work[w] / parallelism[w], reverse=True)
+    return Packing(
+        [workers[w] for w in used],
+        max((work[w] / parallelism[w] for w in used), default=0),
+        lower_bound(costs, max_workers),
+        [parallelism[w] for w in used])
+
+def assign_tasks_to_workers(costs: Dict[str, int], max_workers: int) -> List[List[str]]:
+    '''
+    Assign tasks to workers by minimizing the maximum cost of any worker and then the number of used workers.
+    Unused workers are returned as empty lists.
+    '''
+    workers = pack(costs, max_workers).workers
+    return workers + [[] for _ in range(max_workers - len(workers))]
+
+def plan(ws, workers=None, costs=None, packings=None, sbuild_jobs=None, previous=None, tolerance=0.05) -> List[Job]:
+    '''
+    split the workspace into stages of jobs for parallel workers
 
-    for i, (stage, workers) in enumerate(zip(stages(ws), nr_of_workers())):
+    workers: iterable of the number of workers to use per stage (default: nr_of_workers(...))
+    costs: cost of each repository (default: number of packages)
+    packings: if given, the Packing of the regular tasks of each stage is appended to this list
+    sbuild_jobs: parallel sbuild jobs each repository can use on a runner (see MemoryProfile),
+                 replaces the hand-tuned SBUILD_OPTIONS with memory-aware packing
+    previous: job name of each repository in a previous plan (see read_jobs), repositories stay in the job
+              of the same name where the makespan of the stage stays within tolerance of the one without previous
+    '''
+    if workers is None:
+        workers = nr_of_workers("setup_files" in ws.repositories or "ros_environment" in ws.repositories)
+    if costs is None:
+        costs = {r.name: len(r.packages) for r in ws.repositories.values()}
+
+    plan = []
+    for i, (stage, workers) in enumerate(zip(stages(ws), workers)):
         # repositories with special sbuild options are run in isolated jobs
         # TODO: would fail with bonded repositories, but there are no cases of this yet
-        extra_jobs = [[repo.name] for repo in stage if repo.name in SBUILD_OPTIONS]
+        isolated = SBUILD_OPTIONS if sbuild_jobs is None else {}
+        extra_jobs = [[repo.name] for repo in stage if repo.name in isolated]
 
         # "regular" repositories to be assigned to workers
-        repos = [repo for repo in stage if repo.name not in SBUILD_OPTIONS]
+        repos = [repo for repo in stage if repo.name not in isolated]
 
         # tasks: groups of bonded repositories which need to be built together
+        # the first repository of a group represents the task by name
         tasks = dict()
-        while repos:
-            # select first repository to represent the task by name
-            # and all bonded repositories
-            repo = repos[0]
+        grouped = set()
+        for repo in repos:
+            if repo.name in grouped:
+                continue
             if repo.bonded:
-                tasks[repo.name] = [ws.repositories[br] for br in repo.bonded]
+                tasks[repo.name] = [ws.repositories[br] for br in sorted(repo.bonded)]
             else:
                 tasks[repo.name] = [repo]
+            grouped.update(r.name for r in tasks[repo.name])
 
-            # remove all selected repositories from repos
-            for r in tasks[repo.name]:
-                repos.pop(next(i for i, rr in enumerate(repos) if rr.name == r.name))
+        task_costs = {t : sum(costs[r.name] for r in tasks[t]) for t in tasks}
 
-        # TODO: record the actual compute time of stages and use it as costs instead of package count
-        # TODO: reduce used jobs by merging them to fill current maximum cost of any job
-        costs = {t : sum(len(r.packages) for r in tasks[t]) for t in tasks}
-        worker_tasks = assign_tasks_to_workers(costs, max_workers=workers-len(extra_jobs))
+        # previous workers of this stage by their number, a task takes the one of its most expensive repository
+        prefix = f"stage{i}-worker"
+        def label(repo):
+            job = previous.get(repo, '')
+            return int(job[len(prefix):]) if job.startswith(prefix) and job[len(prefix):].isdigit() else None
+        if previous is not None:
+            extra_labels = [label(job[0]) for job in extra_jobs]
+            reserved = set(l for l in extra_labels if l is not None and extra_labels.count(l) == 1)
+            task_labels = {}
+            for t in tasks:
+                labeled = [r for r in tasks[t] if label(r.name) is not None]
+                if labeled:
+                    task_labels[t] = label(max(labeled, key=lambda r: costs[r.name]).name)
 
-        # unpack worker into a list of repositories
-        jobs = [[repo.name for task in worker for repo in tasks[task]] for worker in worker_tasks if worker]
+        with profiling.span('packing', stage=i, tasks=len(tasks)):
+            if sbuild_jobs is None:
+                if previous is None:
+                    packing = pack(task_costs, max_workers=max(1, workers-len(extra_jobs)))
+                else:
+                    packing, labels = pack_stable(task_costs, max(1, workers-len(extra_jobs)), task_labels, tolerance, reserved)
+            else:
+                task_jobs = {t : min(sbuild_jobs[r.name] for r in tasks[t]) for t in tasks}
+                packing = pack_memory(task_costs, task_jobs, max_workers=workers)
+                if previous is not None:
+                    labels = relabel(packing.workers, task_costs, task_labels)
+        if packings is not None:
+            packings.append(packing)
+        worker_tasks = packing.workers
 
+        # unpack worker into a list of repositories
+        jobs = [[repo.name for task in worker for repo in tasks[task]] for worker in worker_tasks]
+        if previous is None:
+            names = list(range(len(jobs) + len(extra_jobs)))
+        else:
+            taken = set(labels) | reserved
+            fresh = (l for l in itertools.count() if l not in taken)
+            names = labels + [l if l in reserved else next(fresh) for l in extra_labels]
         # plot assignment for visual inspection
         if False:
             import pandas as pd
@@ -124,13 +475,346 @@ if __name__ == '__main__':
             os.makedirs('out', exist_ok=True)
             plt.savefig(f'out/stage{i}.png')
 
-        # write out jobs to yaml
         for ji, job in enumerate(jobs+extra_jobs):
-            repos_yaml = '[{}]'.format(', '.join(f'"{repo}"' for repo in job))
-            print(f"stage{i}-worker{ji}:\n"
-                    f"  repositories: {len(job)}\n"
-                    f"  packages: {sum([len(ws.repositories[repo].packages) for repo in job])}\n"
-                    f"  jobs: {repos_yaml}\n"
-                    , end= '')
-            if next(iter(job)) in SBUILD_OPTIONS:
-                print(f'  sbuild_options: "{SBUILD_OPTIONS[next(iter(job))]}"')
+            plan.append(Job(
+                name=f"stage{i}-worker{names[ji]}",
+                stage=i,
+                repositories=job,
+                packages=sum([len(ws.repositories[repo].packages) for repo in job]),
+                sbuild_options=SBUILD_OPTIONS.get(job[0]) if sbuild_jobs is None else SBUILD_JOBS.format(packing.jobs[ji]),
+                ))
+    return plan
+
+def fuse_stages(ws, jobs: List[Job], costs: Dict[str, float], overhead: float, workers=None, sbuild_jobs=None, previous=None) -> List[Job]:
+    '''
+    merge stages, or parts of them, into the previous stage to save the per-stage overhead
+
+    A bonded group of the next stage can be chained into the worker of the current stage
+    which builds all its dependencies from the current stage (the worker builds its repositories in order)
+    and groups without dependencies in the current stage can go to any worker.
+    A whole stage is merged if the merged stage is not longer than both stages plus the overhead
+    of one stage, otherwise groups are only moved forward if they fit below the current makespan.
+    A first stage which sets up the build environment (setup_files/ros_environment) is never merged.
+    workers: iterable of the most workers per stage of jobs (as for plan(), default: nr_of_workers(...)),
+    a merged stage may use as many workers as the larger of the two stages.
+    With sbuild_jobs (as for plan()) the parallelism of merged workers is derived again,
+    otherwise workers with special sbuild options are not extended.
+    Jobs have to be in stage order, as returned by plan(), the result is renumbered.
+    With previous (as for plan()) the workers of each stage are numbered to keep repositories in jobs of the same name.
+    '''
+    cond = ws.condensation
+    def component(repo):
+        return cond.component[ws.repositories[repo].id]
+    def cost(worker):
+        return sum(costs[r] for unit in worker[1] for r in unit)
+
+    # stages as lists of workers, a worker is [sbuild_options, list of bonded groups]
+    stages = []
+    for job in jobs:
+        if job.stage == len(stages):
+            stages.append([])
+        units = {}
+        for r in job.repositories:
+            units.setdefault(component(r), []).append(r)
+        stages[-1].append([job.sbuild_options if sbuild_jobs is None else None, list(units.values())])
+
+    environment = any(set(job.repositories) & {"setup_files", "ros_environment"} for job in jobs if job.stage == 0)
+    if workers is None:
+        workers = nr_of_workers(environment)
+    limits = list(itertools.islice(workers, len(stages)))
+
+    k = 1 if environment else 0
+    while k + 1 < len(stages):
+        current, following = stages[k], stages[k+1]
+        max_workers = max(limits[k], limits[k+1])
+        makespan = max(cost(w) for w in current)
+        producer = {component(r): i for i, w in enumerate(current) for unit in w[1] for r in unit}
+        def producers(unit):
+            return set(producer[d] for r in unit for d in cond.dependencies(component(r)) if d in producer)
+
+        # try to merge the whole stage
+        fused = [[w[0], list(w[1])] for w in current]
+        free = []
+        isolated = []
+        mergeable = True
+        for w in following:
+            if w[0] is not None:
+                # workers with special sbuild options stay isolated
+                mergeable &= not any(producers(unit) for unit in w[1])
+                isolated.append(w)
+                continue
+            for unit in w[1]:
+                p = producers(unit)
+                if len(p) == 1 and fused[next(iter(p))][0] is None:
+                    fused[next(iter(p))][1].append(unit)
+                elif not p:
+                    free.append(unit)
+                else:
+                    mergeable = False
+        if mergeable and len(fused) + len(isolated) <= max_workers:
+            regular = [w for w in fused if w[0] is None]
+            regular += [[None, []] for _ in range(max_workers - len(fused) - len(isolated))]
+            heap = [(cost(w), i) for i, w in enumerate(regular)]
+            heapq.heapify(heap)
+            for unit in sorted(free, key=lambda u: sum(costs[r] for r in u), reverse=True):
+                load, i = heapq.heappop(heap)
+                regular[i][1].append(unit)
+                heapq.heappush(heap, (load + sum(costs[r] for r in unit), i))
+            merged = [w for w in regular if w[1]] + [w for w in fused if w[0] is not None] + isolated
+            if max(cost(w) for w in merged) <= makespan + max(cost(w) for w in following) + overhead:
+                stages[k] = merged
+                limits[k] = max_workers
+                del stages[k+1]
+                del limits[k+1]
+                continue
+
+        # move groups forward which do not lengthen the current stage
+        for w in following:
+            if w[0] is not None:
+                continue
+            for unit in list(w[1]):
+                p = producers(unit)
+                if len(p) > 1:
+                    continue
+                target = current[next(iter(p))] if p else min((t for t in current if t[0] is None), key=cost, default=None)
+                if target is None or target[0] is not None:
+                    continue
+                if cost(target) + sum(costs[r] for r in unit) <= makespan:
+                    w[1].remove(unit)
+                    target[1].append(unit)
+        stages[k+1] = [w for w in following if w[1]]
+        if not stages[k+1]:
+            del stages[k+1]
+            del limits[k+1]
+            continue
+        k += 1
+
+    fused_jobs = []
+    for i, stage in enumerate(stages):
+        names = list(range(len(stage)))
+        if previous is not None:
+            prefix = f"stage{i}-worker"
+            labels = {r: int(previous[r][len(prefix):]) for r in costs if previous.get(r, '').startswith(prefix) and previous[r][len(prefix):].isdigit()}
+            names = relabel([[r for unit in units for r in unit] for _, units in stage], costs, labels)
+        for wi, (options, units) in enumerate(stage):
+            repositories = [r for unit in units for r in unit]
+            fused_jobs.append(Job(
+                name=f"stage{i}-worker{names[wi]}",
+                stage=i,
+                repositories=repositories,
+                packages=sum([len(ws.repositories[repo].packages) for repo in repositories]),
+                sbuild_options=options if sbuild_jobs is None else SBUILD_JOBS.format(min(sbuild_jobs[r] for r in repositories)),
+                ))
+    return fused_jobs
+
+def schedule_dag(ws, jobs: List[Job], costs: Dict[str, float]):
+    '''
+    replace the barriers between stages with dependencies between the jobs building them
+
+    Sets `needs` of every job to the jobs which build its direct dependencies
+    (and the jobs of the first stage which set up the build environment)
+    and computes the earliest start of each job assuming all needed jobs run as early as possible.
+    Jobs have to be in stage order, as returned by plan().
+    Returns (makespan, critical path as list of job names, earliest start of each job).
+    '''
+    cond = ws.condensation
+    job_of = {repo: job.name for job in jobs for repo in job.repositories}
+    order = {job.name: i for i, job in enumerate(jobs)}
+    environment = [job.name for job in jobs if set(job.repositories) & {"setup_files", "ros_environment"}]
+
+    start = {}
+    finish = {}
+    critical = {}
+    for job in jobs:
+        needs = set()
+        for repo in job.repositories:
+            for c in cond.dependencies(cond.component[ws.repositories[repo].id]):
+                needs.update(job_of[r.name] for r in ws.group(c))
+        if job.stage > 0:
+            needs.update(environment)
+        # only jobs of earlier stages are built before this one in the staged plan as well
+        # (setup_files/ros_environment are forced into the first stage)
+        job.needs = sorted([n for n in needs if order[n] < order[job.name]], key=order.get)
+
+        start[job.name] = max((finish[n] for n in job.needs), default=0)
+        critical[job.name] = max(job.needs, key=lambda n: finish[n], default=None)
+        finish[job.name] = start[job.name] + sum(costs[r] for r in job.repositories)
+
+    if not jobs:
+        return 0, [], start
+    path = [max(finish, key=finish.get)]
+    while critical[path[-1]]:
+        path.append(critical[path[-1]])
+    return finish[path[0]], path[::-1], start
+
+def tune_workers(ws, costs: Dict[str, float], runners: Runners, slack: float, max_workers: int = 20, sbuild_jobs=None) -> List[int]:
+    '''
+    number of workers for each stage of plan() with the least runner time among all plans
+    whose makespan on runners is within slack (e.g. 0.1 for 10%) of the fastest one
+
+    Every stage is planned with 1..max_workers workers, the stage building the environment always uses one.
+    '''
+    environment = "setup_files" in ws.repositories or "ros_environment" in ws.repositories
+    loads = []
+    for w in range(1, max_workers+1):
+        jobs = plan(ws, itertools.chain([1] if environment else [], itertools.repeat(w)), costs, sbuild_jobs=sbuild_jobs)
+        for job in jobs:
+            while len(loads) <= job.stage:
+                loads.append([])
+            options = loads[job.stage]
+            while len(options) < w:
+                options.append([])
+            options[w-1].append(sum(costs[r] for r in job.repositories))
+    time, runner_time = stage_options(loads, runners)
+    return [w + 1 for w in cheapest(time, runner_time, slack)]
+
+def staged_makespan(jobs: List[Job], costs: Dict[str, float]):
+    '''
+    makespan of a plan where every stage waits for all jobs of the previous stage
+    '''
+    stage_costs = {}
+    for job in jobs:
+        stage_costs[job.stage] = max(stage_costs.get(job.stage, 0), sum(costs[r] for r in job.repositories))
+    return sum(stage_costs.values())
+
+def write_jobs(jobs: List[Job], file=sys.stdout):
+    '''
+    write out jobs to yaml
+    '''
+    for job in jobs:
+        repos_yaml = '[{}]'.format(', '.join(f'"{repo}"' for repo in job.repositories))
+        print(f"{job.name}:\n"
+                f"  repositories: {len(job.repositories)}\n"
+                f"  packages: {job.packages}\n"
+                f"  jobs: {repos_yaml}\n"
+                , end= '', file=file)
+        if job.needs is not None:
+            needs_yaml = '[{}]'.format(', '.join(f'"{n}"' for n in job.needs))
+            print(f"  needs: {needs_yaml}", file=file)
+        if job.sbuild_options is not None:
+            print(f'  sbuild_options: "{job.sbuild_options}"', file=file)
+
+def read_jobs(filename) -> Dict[str, str]:
+    '''
+    job name of each repository in a jobs.yaml written by write_jobs
+    '''
+    # only needed for --previous
+    import yaml
+    with open(filename) as f:
+        jobs = yaml.safe_load(f) or {}
+    return {repo: name for name, job in jobs.items() for repo in job['jobs']}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="split a workspace into stages of parallel sbuild jobs and print them as yaml")
+    parser.add_argument('workspace', nargs='?', default='.')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help="processes used to parse package.xml files (0: all cores)")
+    parser.add_argument('--schedule', choices=['staged', 'dag'], default='staged',
+                        help="staged: every stage waits for the previous one, dag: jobs only wait for the jobs building their dependencies")
+    parser.add_argument('--history', nargs='+', metavar='FILE',
+                        help="json/csv files with sbuild durations of past runs to balance workers by build time instead of package count")
+    parser.add_argument('--estimator', choices=['ewma', 'percentile'], default='ewma', help="how to estimate build times from the history")
+    parser.add_argument('--alpha', type=float, default=0.3, help="weight of the most recent run for ewma")
+    parser.add_argument('--percentile', type=float, default=90)
+    parser.add_argument('--packages-up-to', nargs='+', default=[], metavar='NAME',
+                        help="only plan these repositories/packages and their dependencies")
+    parser.add_argument('--packages-above', nargs='+', default=[], metavar='NAME',
+                        help="only plan these repositories/packages and everything depending on them")
+    parser.add_argument('--packages-select', nargs='+', default=[], metavar='NAME',
+                        help="only plan these repositories/packages")
+    parser.add_argument('--fuse', type=float, metavar='OVERHEAD',
+                        help="merge stages where this does not lengthen the plan, given the overhead of a stage (runner startup, cache restore, aggregation) in units of the costs")
+    parser.add_argument('--memory-profile', metavar='FILE',
+                        help="json with peak memory of repositories to derive sbuild --jobs per worker instead of using SBUILD_OPTIONS")
+    parser.add_argument('--runner-memory', type=float, default=16384, help="memory of a runner in MB")
+    parser.add_argument('--runner-cores', type=int, default=4, help="cores of a runner")
+    parser.add_argument('--tune', type=float, metavar='SLACK',
+                        help="choose the workers of each stage for the least runner time among plans with a simulated makespan within SLACK (e.g. 0.1) of the fastest")
+    parser.add_argument('--max-workers', type=int, default=20, help="most workers per stage to consider with --tune")
+    parser.add_argument('--runner-startup', type=float, default=0, help="time until a runner starts a job, in units of the costs")
+    parser.add_argument('--cache-restore', type=float, default=0, help="time to restore caches at the start of a job, in units of the costs")
+    parser.add_argument('--cache-save', type=float, default=0, help="time to save caches at the end of a job, in units of the costs")
+    parser.add_argument('--concurrency', type=int, default=20, help="jobs running at the same time")
+    parser.add_argument('--previous', metavar='FILE',
+                        help="jobs.yaml of a previous run, repositories stay in the job of the same name where possible (for the caches of the workers), with --fuse only the jobs are named to match")
+    parser.add_argument('--tolerance', type=float, default=0.05,
+                        help="with --previous: how much longer (e.g. 0.05 for 5%%) the makespan of a stage may get to keep repositories in place")
+    parser.add_argument('-v', '--verbose', action='store_true', help="report the packing of every stage")
+    profiling.add_arguments(parser)
+    args = parser.parse_args()
+    profiling.enable_from_arguments(args)
+
+    with profiling.span('workspace'):
+        ws = Workspace(args.workspace, jobs=args.jobs)
+    if args.packages_up_to or args.packages_above or args.packages_select:
+        # dependencies outside of the selection are available from previous builds
+        with profiling.span('select'):
+            try:
+                selected = ws.select(up_to=args.packages_up_to, above=args.packages_above, repositories=args.packages_select)
+            except KeyError as e:
+                parser.error(e.args[0])
+            ws.restrict(selected)
+    if args.history:
+        costs = BuildTimes.load(*args.history).costs(ws, method=args.estimator, alpha=args.alpha, percentile=args.percentile)
+    else:
+        costs = {r.name: len(r.packages) for r in ws.repositories.values()}
+
+    sbuild_jobs = None
+    if args.memory_profile:
+        profile = MemoryProfile(args.memory_profile)
+        sbuild_jobs = {r: profile.sbuild_jobs(r, args.runner_memory, args.runner_cores) for r in ws.repositories}
+
+    runners = Runners(args.runner_startup, args.cache_restore, args.cache_save, args.concurrency)
+    workers = None
+    if args.tune is not None:
+        with profiling.span('tune'):
+            workers = tune_workers(ws, costs, runners, args.tune, args.max_workers, sbuild_jobs)
+        default = simulate(plan(ws, costs=costs, sbuild_jobs=sbuild_jobs), costs, runners)
+        print(f"tuning: workers per stage {' '.join(map(str, workers))} "
+              f"(default plan: makespan {default.makespan:.0f}, runner time {default.runner_time:.0f})", file=sys.stderr)
+
+    previous = read_jobs(args.previous) if args.previous else None
+    packings = []
+    with profiling.span('plan'):
+        # stages of a fused plan do not correspond to the ones of plan(), its jobs are only named after the previous ones
+        jobs = plan(ws, workers=workers, costs=costs, packings=packings, sbuild_jobs=sbuild_jobs,
+                    previous=previous if args.fuse is None else None, tolerance=args.tolerance)
+    if previous is not None and args.fuse is None:
+        # with --fuse previous only names the jobs and does not change the plan
+        planned = staged_makespan(jobs, costs)
+        unconstrained = staged_makespan(plan(ws, workers=workers, costs=costs, sbuild_jobs=sbuild_jobs), costs)
+    if args.fuse is not None:
+        stage_count = jobs[-1].stage + 1 if jobs else 0
+        before = staged_makespan(jobs, costs)
+        with profiling.span('fuse'):
+            jobs = fuse_stages(ws, jobs, costs, args.fuse, workers=workers, sbuild_jobs=sbuild_jobs, previous=previous)
+        fused = stage_count - (jobs[-1].stage + 1 if jobs else 0)
+        print(f"fusion: {stage_count} -> {stage_count - fused} stages, removed {fused * args.fuse:.0f} of stage overhead "
+              f"(makespan without overhead {before:.0f} -> {staged_makespan(jobs, costs):.0f})", file=sys.stderr)
+    staged = staged_makespan(jobs, costs)
+    if args.verbose:
+        for i, p in enumerate(packings):
+            print(f"stage{i}: {len(p.workers)} workers, makespan {p.makespan:.0f}, lower bound {p.lower_bound:.0f} (gap {p.gap:.1%})", file=sys.stderr)
+    print(f"packing: {sum(len(p.workers) for p in packings)} workers, "
+          f"lower bound {sum(p.lower_bound for p in packings):.0f} for makespan {sum(p.makespan for p in packings):.0f} of all stages "
+          f"(largest gap {max((p.gap for p in packings), default=0):.1%})", file=sys.stderr)
+    if args.schedule == 'dag':
+        with profiling.span('schedule'):
+            makespan, critical_path, _ = schedule_dag(ws, jobs, costs)
+        print(f"makespan: {makespan:.0f} (staged: {staged:.0f})", file=sys.stderr)
+        print(f"critical path: {' -> '.join(critical_path)}", file=sys.stderr)
+    else:
+        print(f"makespan: {staged:.0f}", file=sys.stderr)
+
+    if args.tune is not None or runners.overhead > 0:
+        simulation = simulate(jobs, costs, runners, staged=args.schedule == 'staged')
+        print(f"simulation: makespan {simulation.makespan:.0f}, runner time {simulation.runner_time:.0f} "
+              f"({len(jobs)} jobs, at most {runners.concurrency} at a time)", file=sys.stderr)
+
+    if previous is not None:
+        repositories = [r for job in jobs for r in job.repositories]
+        moved = sum(1 for job in jobs for r in job.repositories if r in previous and previous[r] != job.name)
+        new = sum(1 for r in repositories if r not in previous)
+        makespans = f", makespan {planned:.0f} ({unconstrained:.0f} without --previous)" if args.fuse is None else ""
+        print(f"stability: {moved} of {len(repositories)} repositories moved to another job ({new} new){makespans}", file=sys.stderr)
+
+    write_jobs(jobs)
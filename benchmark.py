@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+
+import argparse
+import contextlib
+import gitinfo
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from autosplit import assign_tasks_to_workers, plan, stages
+from catkin_pkg.package import InvalidPackage
+from pathlib import Path
+from splitter import Interface
+from workspace import RepositoryMap, UnusualManifest, Workspace, WorkspaceIndex, catkin_manifest, condition_context, extract_manifest, parse_manifest
+
+def timed(fn, repeat):
+    '''
+    returns (result of the last call, durations of repeat calls in seconds)
+    '''
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        durations.append(time.perf_counter() - start)
+    return result, durations
+
+def read_manifests(ws):
+    '''
+    returns [(filename, content)] of all package.xml files in ws
+    '''
+    manifests = []
+    for path in RepositoryMap(Path(ws)).packages:
+        filename = Path(ws) / path / 'package.xml'
+        manifests.append((str(filename), filename.read_bytes()))
+    return manifests
+
+def check_manifests(ws):
+    '''
+    compares the fast manifest extraction with catkin_pkg on all manifests of ws
+    Invalid manifests have to be rejected by both.
+    returns (number of manifests left to catkin_pkg, files with differing results)
+    '''
+    context = condition_context()
+    fallbacks = 0
+    mismatches = []
+    def parse(parser, filename, data):
+        try:
+            return parser(filename, data, context)
+        except InvalidPackage:
+            return InvalidPackage
+    for filename, data in read_manifests(ws):
+        try:
+            extracted = parse(extract_manifest, filename, data)
+        except UnusualManifest:
+            fallbacks += 1
+            continue
+        if extracted != parse(catkin_manifest, filename, data):
+            mismatches.append(filename)
+    return fallbacks, mismatches
+
+def benchmark(ws, repeat=3, samples=20, seed=0):
+    '''
+    returns {name: {'min', 'median', 'runs', 'calls'}} timings of the main operations on workspace ws
+    Operations which are cheap per call run `samples` times per measurement, 'calls' says how often.
+    '''
+    results = {}
+    rnd = random.Random(seed)
+
+    def measure(name, fn, calls=1, repeat=repeat):
+        result, durations = timed(fn, repeat)
+        results[name] = {'min': min(durations), 'median': statistics.median(durations), 'runs': durations, 'calls': calls}
+        print(f"  {name}: {min(durations):.4f}s", file=sys.stderr)
+        return result
+
+    context = condition_context()
+    manifests = read_manifests(ws)
+    measure('manifests_catkin', lambda: [catkin_manifest(f, data, context) for f, data in manifests], len(manifests))
+    measure('manifests_extract', lambda: [parse_manifest(f, data, context) for f, data in manifests], len(manifests))
+
+    index = Path(ws) / WorkspaceIndex.FILENAME
+    def cold():
+        if index.exists():
+            index.unlink()
+        return Workspace(ws)
+    measure('workspace_cold', lambda: Workspace(ws, index=False))
+    measure('workspace_index_build', cold)
+    w = measure('workspace_indexed', lambda: Workspace(ws))
+
+    repos = sorted(w.repositories)
+    sample = [rnd.choice(repos) for _ in range(samples)]
+    packages = [rnd.choice(sorted(w.packages)) for _ in range(samples)]
+    measure('detect_cycle', lambda: [w.detect_cycle(w.repositories[r]) for r in sample], samples)
+    staged = measure('stages', lambda: list(stages(w)))
+    measure('assign_tasks_to_workers', lambda: [assign_tasks_to_workers({r.name: len(r.packages) for r in s}, 10) for s in staged], len(staged))
+    measure('plan', lambda: plan(w))
+
+    def closure():
+        w.package_graph.derived.clear()
+        return w.package_graph.reachability()
+    measure('closure', closure)
+    measure('query_rdeps', lambda: [w.dependencies(p, reverse=True) for p in packages], samples)
+    measure('query_chain', lambda: [w.longest_chain(p) for p in packages], samples)
+
+    # the splitter prints a lot, none of it is part of the measurement
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull), tempfile.TemporaryDirectory() as out:
+        interface = measure('splitter', lambda: Interface(ws))
+        interface.stdout = devnull
+        measure('splitter_autogroup', lambda: interface.onecmd('autogroup 8'))
+        measure('splitter_group', lambda: [interface.onecmd(f'group {g}') for g in interface.group_names], len(interface.group_names))
+        moves = [f'move {r} {rnd.choice(interface.group_names)}' for r in sample]
+        measure('splitter_move_closure', lambda: [interface.onecmd(f'{m} deps rdeps preview') for m in moves], samples)
+        # moves change the groups, so they can only be measured once
+        before = len(interface.history)
+        measure('splitter_move', lambda: [interface.onecmd(m) for m in moves], samples, repeat=1)
+        moved = len(interface.history) - before
+        measure('splitter_undo', lambda: [interface.onecmd('undo') for _ in range(moved)] + [interface.onecmd('redo') for _ in range(moved)], 2 * moved, repeat=1)
+
+        def export():
+            gitinfo._cache.clear()
+            cwd = os.getcwd()
+            os.chdir(out)
+            try:
+                interface.onecmd('export')
+            finally:
+                os.chdir(cwd)
+        measure('splitter_export', export)
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="time the workspace tools on synthetic workspaces of growing size and print the results as json")
+    parser.add_argument('--scales', default='100,1000', help="comma separated numbers of repositories to generate workspaces with")
+    parser.add_argument('--workspace', nargs='+', default=[], help="benchmark these existing workspaces instead")
+    parser.add_argument('--packages-per-repository', type=float, default=3)
+    parser.add_argument('--density', type=float, default=2.0, help="average number of workspace dependencies per package")
+    parser.add_argument('--bonds', type=float, default=0.01, help="rings of 3 repositories depending on each other per repository")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--samples', type=int, default=20, help="calls per measurement of cheap operations")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workdir', help="generate workspaces here and keep them (default: temporary directory)")
+    parser.add_argument('-o', '--output', default='-', help="json file to write the results to ('-' for stdout)")
+    args = parser.parse_args()
+
+    workdir = Path(args.workdir or tempfile.mkdtemp(prefix='ws-benchmark-'))
+    workspaces = list(args.workspace)
+    if not workspaces:
+        for scale in (int(s) for s in args.scales.split(',')):
+            ws = workdir / f"ws{scale}"
+            if not ws.exists():
+                subprocess.run([sys.executable, Path(__file__).with_name('gen-workspace.py'), ws,
+                                '--repositories', str(scale),
+                                '--packages', str(round(scale * args.packages_per_repository)),
+                                '--density', str(args.density),
+                                '--bonds', str(round(scale * args.bonds)),
+                                '--seed', str(args.seed)],
+                               check=True, stdout=sys.stderr)
+            workspaces.append(str(ws))
+
+    results = []
+    for ws in workspaces:
+        print(f"benchmarking {ws}", file=sys.stderr)
+        fallbacks, mismatches = check_manifests(ws)
+        for filename in mismatches:
+            print(f"ERROR: fast extraction of {filename} differs from catkin_pkg", file=sys.stderr)
+        timings = benchmark(ws, args.repeat, args.samples, args.seed)
+        w = Workspace(ws)
+        results.append({
+            'workspace': ws,
+            'repositories': len(w.repositories),
+            'packages': len(w.packages),
+            'dependencies': int(len(w.package_graph.edges()[0])),
+            'manifest_fallbacks': fallbacks,
+            'manifest_mismatches': mismatches,
+            'timings': timings,
+            })
+    if not args.workdir and not args.workspace:
+        shutil.rmtree(workdir)
+
+    report = {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'timestamp': time.time(),
+        'results': results,
+        }
+    if args.output == '-':
+        json.dump(report, sys.stdout, indent=1)
+        print()
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
@@ -1,12 +1,49 @@
 #!/usr/bin/env python
 
+import argparse
 import em
+import re
+import yaml
 
-required_stages = 19
-#first_stages = [1, 10]
-#workers = first_stages + [5] * (required_stages - len(first_stages))
-first_stages = [1]
-workers = first_stages + [10] * (required_stages - len(first_stages))
+parser = argparse.ArgumentParser(description="generate the github workflow for the jobs planned by autosplit.py")
+parser.add_argument('jobs', nargs='?', default='jobs.yaml', help="jobs.yaml written by autosplit.py")
+args = parser.parse_args()
+
+with open(args.jobs) as f:
+    jobs = yaml.safe_load(f) or {}
+
+# only the workers which exist in the plan, grouped by stage
+stages = []
+for worker in jobs:
+    stage = int(re.fullmatch(r'stage(\d+)-worker\d+', worker).group(1))
+    while len(stages) <= stage:
+        stages.append([])
+    stages[stage].append(worker)
+
+def producers(worker, found):
+    '''
+    adds the jobs worker (transitively) needs to found, dependencies first
+    '''
+    for n in jobs[worker].get('needs', []):
+        if n not in found:
+            producers(n, found)
+            found[n] = None
+    return found
+
+# `depends` lists the jobs whose debs worker.yaml restores (apt-repo-<job>-...) before building:
+# plans scheduled as dag list the jobs each worker has to wait for, so a worker restores the
+# metadata of stage-1 plus the debs of every job it transitively needs, otherwise each worker
+# waits for and restores the cumulative aggregation of the previous stage
+dag = any('needs' in job for job in jobs.values())
+needs = {}
+depends = {}
+for i, workers in enumerate(stages):
+    for worker in workers:
+        if dag:
+            needs[worker] = '[{}]'.format(', '.join(['stage-1'] + jobs[worker].get('needs', [])))
+            depends[worker] = '"{}"'.format(' '.join(['stage-1'] + list(producers(worker, {}))))
+        else:
+            needs[worker] = depends[worker] = f'stage{i-1}'
 
 template = R"""name: build
 
@@ -21,8 +58,6 @@ env:
 jobs:
   stage-1:
     runs-on: ubuntu-24.04
-    outputs:
-      workers: ${{ steps.worker.outputs.workers }}
     steps:
       - name: Check out the repo
         uses: actions/checkout@@v4
@@ -42,10 +77,8 @@ jobs:
             printf "%s:\n  %s:\n  - %s\n" "$PKG" "${{ env.DISTRIBUTION }}" "ros-one-$(printf '%s' "$PKG" | tr '_' '-')" | tee -a local.yaml
           done
       - name: List used workers
-        id: worker
         run: |
           cat jobs.yaml
-          echo "workers=$(cat jobs.yaml | sed -n '/^stage.*:$/ p' | tr -d '\n')" >> $GITHUB_OUTPUT
       - name: Prepare meta data cache
         run: |
           mkdir -p ${{ env.AGG }}
@@ -58,18 +91,18 @@ jobs:
         with:
           path: ${{ env.AGG }}
           key: apt-repo-stage-1-${{ github.sha }}-${{ github.run_id }}-${{ github.run_attempt }}
-@[for i, workers in stages]@[for j in range(workers)]
-  stage@i-worker@j:
+@[for i, workers in enumerate(stages)]@[for worker in workers]
+  @worker:
     uses: ./.github/workflows/worker.yaml
-    if: (always() && !cancelled()) && contains( needs.stage-1.outputs.workers, 'stage@i-worker@j' )
-    needs: stage@(i-1)
+    if: always() && !cancelled()
+    needs: @(needs[worker])
     with:
-      worker: stage@i-worker@j
-      depends: stage@(i-1)@[end for]
+      worker: @worker
+      depends: @(depends[worker])@[end for]
   stage@i:
     uses: ./.github/workflows/aggregate-debs.yaml
     if: always() && !cancelled()
-    needs: [@[for j in range(workers)]stage@(i)-worker@j, @[end for]]
+    needs: [@[for worker in workers]@worker, @[end for]@[if dag and i > 0]stage@(i-1)@[end if]]
     with:
       stage: @i
 @[end for]
@@ -99,4 +132,4 @@ jobs:
 """
 
 
-print(em.expand(template, stages=enumerate(workers), last_stage=required_stages-1), end='')
+print(em.expand(template, stages=stages, needs=needs, depends=depends, dag=dag, last_stage=len(stages)-1), end='')
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+import argparse
+import csv
+import json
+import numpy as np
+from typing import Dict, List
+
+class BuildTimes:
+    '''
+    history of per-repository sbuild durations (in seconds) from past CI runs
+
+    Records are read from and written to json as a list of
+    {"repository": str, "duration": float, "timestamp": float (optional)} entries.
+    Csv files with the same columns can be ingested as well.
+    '''
+    def __init__(self):
+        # repository -> list of (timestamp, duration)
+        self.records = {}
+
+    @classmethod
+    def load(cls, *filenames):
+        history = cls()
+        for filename in filenames:
+            history.ingest(filename)
+        return history
+
+    def ingest(self, filename):
+        with open(filename, newline='') as f:
+            if filename.endswith('.csv'):
+                records = list(csv.DictReader(f))
+            else:
+                records = json.load(f)
+        for r in records:
+            self.add(r['repository'], float(r['duration']), float(r['timestamp']) if r.get('timestamp') not in (None, '') else None)
+
+    def add(self, repository, duration, timestamp=None):
+        self.records.setdefault(repository, []).append((timestamp, duration))
+
+    def save(self, filename):
+        with open(filename, 'w') as f:
+            json.dump([{'repository': repo, 'duration': d, **({'timestamp': t} if t is not None else {})}
+                       for repo, records in sorted(self.records.items()) for t, d in records], f, indent=1)
+
+    def durations(self, repository) -> List[float]:
+        '''
+        durations of repository, oldest first (records without timestamp keep their order of ingestion)
+        '''
+        records = self.records.get(repository, [])
+        order = sorted(range(len(records)), key=lambda i: (records[i][0] is not None, records[i][0] or 0, i))
+        return [records[i][1] for i in order]
+
+    def estimate(self, repository, method='ewma', alpha=0.3, percentile=90):
+        '''
+        smoothed build time of repository or None without history
+
+        method: 'ewma' weights recent runs by alpha, 'percentile' takes the given percentile of all runs
+        '''
+        durations = self.durations(repository)
+        if not durations:
+            return None
+        if method == 'percentile':
+            return float(np.percentile(durations, percentile))
+        estimate = durations[0]
+        for d in durations[1:]:
+            estimate = alpha * d + (1 - alpha) * estimate
+        return estimate
+
+    def costs(self, ws, **kwargs) -> Dict[str, float]:
+        '''
+        estimated build time of every repository in ws
+        '''
+        return self.sized_costs({r.name: len(r.packages) for r in ws.repositories.values()}, **kwargs)
+
+    def sized_costs(self, packages: Dict[str, int], **kwargs) -> Dict[str, float]:
+        '''
+        estimated build time of every repository in packages, which maps repositories to their number of packages
+
+        Repositories without history are estimated by a per-package cost fitted
+        (least squares through the origin) on all repositories with history.
+        Without any history the cost of a repository is its number of packages.
+        '''
+        estimates = {r: self.estimate(r, **kwargs) for r in packages}
+        known = [(packages[r], e) for r, e in estimates.items() if e is not None]
+        per_package = sum(p * e for p, e in known) / sum(p * p for p, _ in known) if known else 1.0
+        return {r: e if e is not None else per_package * packages[r] for r, e in estimates.items()}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="merge sbuild durations into a build time history and print the current estimates")
+    parser.add_argument('history', help="json file with the build time history, created if it does not exist")
+    parser.add_argument('records', nargs='*', help="json/csv files with new records to add to the history")
+    parser.add_argument('--estimator', choices=['ewma', 'percentile'], default='ewma')
+    parser.add_argument('--alpha', type=float, default=0.3, help="weight of the most recent run for ewma")
+    parser.add_argument('--percentile', type=float, default=90)
+    args = parser.parse_args()
+
+    try:
+        history = BuildTimes.load(args.history)
+    except FileNotFoundError:
+        history = BuildTimes()
+    for filename in args.records:
+        history.ingest(filename)
+    if args.records:
+        history.save(args.history)
+
+    for repo in sorted(history.records):
+        print(f"{repo}: {history.estimate(repo, args.estimator, args.alpha, args.percentile):.0f}s ({len(history.records[repo])} runs)")
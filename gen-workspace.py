@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+
+import argparse
+import os
+import random
+from pathlib import Path
+
+# dependency tags of each manifest format and how often they are used
+TAGS = {
+    1: [('build_depend', 5), ('run_depend', 4), ('test_depend', 1)],
+    2: [('build_depend', 4), ('exec_depend', 3), ('depend', 2), ('test_depend', 1)],
+    3: [('build_depend', 4), ('exec_depend', 3), ('depend', 2), ('test_depend', 1)],
+}
+
+# pairs of tags which may declare the same dependency
+PAIRS = {
+    1: [('build_depend', 'run_depend')],
+    2: [('build_depend', 'exec_depend'), ('build_depend', 'test_depend'), ('exec_depend', 'test_depend'), ('depend', 'test_depend')],
+}
+PAIRS[3] = PAIRS[2]
+
+def manifest(name, format, depends, rnd):
+    '''
+    package.xml of format declaring depends as randomly chosen dependency tags
+    Some dependencies are declared by two tags, as in build_depend and exec_depend of the same package.
+    Format 3 manifests get some dependencies which only apply to ROS 1 or ROS 2.
+    '''
+    tags, weights = zip(*TAGS[format])
+    lines = []
+    for d in depends:
+        if rnd.random() < 0.15:
+            pair = rnd.choice(PAIRS[format])
+        else:
+            pair = rnd.choices(tags, weights)
+        condition = ''
+        if format == 3 and rnd.random() < 0.1:
+            condition = f' condition="$ROS_VERSION == {rnd.choice([1, 2])}"'
+        lines.extend(f'  <{tag}{condition}>{d}</{tag}>' for tag in pair)
+    schema = f'<package format="{format}">' if format > 1 else '<package>'
+    return (
+        '<?xml version="1.0"?>\n'
+        f'{schema}\n'
+        f'  <name>{name}</name>\n'
+        '  <version>1.0.0</version>\n'
+        f'  <description>synthetic package {name}</description>\n'
+        '  <maintainer email="dev@example.com">dev</maintainer>\n'
+        '  <license>BSD</license>\n'
+        '  <buildtool_depend>catkin</buildtool_depend>\n'
+        + ''.join(l + '\n' for l in lines) +
+        '</package>\n'
+    )
+
+def git(path, name, rnd):
+    '''
+    minimal .git with a branch tracking a remote, enough for gitinfo.read_git
+    '''
+    branch = rnd.choice(['main', 'master', 'noetic-devel'])
+    gitdir = path / '.git'
+    (gitdir / 'refs' / 'heads').mkdir(parents=True, exist_ok=True)
+    (gitdir / 'HEAD').write_text(f"ref: refs/heads/{branch}\n")
+    (gitdir / 'config').write_text(
+        '[core]\n'
+        '\trepositoryformatversion = 0\n'
+        f'[remote "origin"]\n'
+        f'\turl = https://example.com/ros/{name}.git\n'
+        '\tfetch = +refs/heads/*:refs/remotes/origin/*\n'
+        f'[branch "{branch}"]\n'
+        '\tremote = origin\n'
+        f'\tmerge = refs/heads/{branch}\n'
+    )
+
+def generate(ws, repositories, packages, density=2.0, cycles=0, bonds=0, bond_size=3, external=20, formats=(1, 2, 3), seed=0):
+    '''
+    create a workspace of synthetic git repositories with package.xml files in ws
+
+    packages: total number of packages, distributed randomly over the repositories
+    density: average number of workspace dependencies per package
+    cycles: number of dependencies from a package to a later one, likely making repositories bonded
+    bonds: number of rings of bond_size consecutive repositories depending on each other
+    external: number of dependencies outside of the workspace (rosdep keys) to choose from
+    returns the number of dependencies declared between workspace packages
+    '''
+    rnd = random.Random(seed)
+    ws = Path(ws)
+    packages = max(packages, repositories)
+
+    # every repository gets one package, the rest is spread randomly
+    sizes = [1] * repositories
+    for _ in range(packages - repositories):
+        sizes[rnd.randrange(repositories)] += 1
+    names = [[f"pkg{r}_{k}" for k in range(n)] for r, n in enumerate(sizes)]
+    flat = [(r, p) for r, ps in enumerate(names) for p in ps]
+
+    # dependencies only point to earlier packages, apart from the cycles added afterwards
+    depends = {p: set() for _, p in flat}
+    for i, (r, p) in enumerate(flat):
+        for _ in range(min(i, round(rnd.expovariate(1 / density)) if density > 0 else 0)):
+            # prefer recent packages to get long dependency chains
+            depends[p].add(flat[int(i * (1 - rnd.random() ** 2))][1])
+    for _ in range(cycles):
+        i, j = sorted(rnd.sample(range(len(flat)), 2))
+        depends[flat[i][1]].add(flat[j][1])
+    for b in range(bonds):
+        first = rnd.randrange(max(1, repositories - bond_size + 1))
+        ring = list(range(first, min(repositories, first + bond_size)))
+        for r, s in zip(ring, ring[1:] + ring[:1]):
+            if r != s:
+                depends[rnd.choice(names[r])].add(rnd.choice(names[s]))
+    edges = sum(len(d) for d in depends.values())
+
+    for r, ps in enumerate(names):
+        name = f"repo{r}"
+        path = ws / name
+        path.mkdir(parents=True, exist_ok=True)
+        git(path, name, rnd)
+        for p in ps:
+            pkg_path = path / p if len(ps) > 1 else path
+            pkg_path.mkdir(exist_ok=True)
+            deps = sorted(depends[p].difference([p]))
+            deps += [f"ext{e}" for e in rnd.sample(range(external), min(external, rnd.randint(0, 2)))]
+            (pkg_path / 'package.xml').write_text(manifest(p, rnd.choice(formats), deps, rnd))
+    return edges
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="generate a synthetic workspace of git repositories with ROS packages")
+    parser.add_argument('workspace', help="directory to create the repositories in")
+    parser.add_argument('-r', '--repositories', type=int, default=100)
+    parser.add_argument('-p', '--packages', type=int, help="total number of packages (default: 3 per repository)")
+    parser.add_argument('-d', '--density', type=float, default=2.0, help="average number of workspace dependencies per package")
+    parser.add_argument('--cycles', type=int, default=0, help="number of random dependencies against the dependency order")
+    parser.add_argument('--bonds', type=int, default=0, help="number of rings of repositories depending on each other")
+    parser.add_argument('--bond-size', type=int, default=3)
+    parser.add_argument('--external', type=int, default=20, help="number of distinct dependencies outside of the workspace")
+    parser.add_argument('--formats', default='1,2,3', help="comma separated package.xml formats to use")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    os.makedirs(args.workspace, exist_ok=True)
+    edges = generate(args.workspace, args.repositories, args.packages or 3 * args.repositories,
+                     args.density, args.cycles, args.bonds, args.bond_size, args.external,
+                     [int(f) for f in args.formats.split(',')], args.seed)
+    print(f"generated {args.repositories} repositories with {args.packages or 3 * args.repositories} packages and {edges} dependencies in {args.workspace}")
@@ -0,0 +1,173 @@
+# git metadata of workspace repositories, read from .git directly where possible
+
+import concurrent.futures
+import os
+import profiling
+import re
+from pathlib import Path
+
+def git_dir(path):
+    '''
+    returns the git directory of the repository rooted at path
+    resolving `.git` files as used by worktrees and submodules
+    '''
+    dot_git = Path(path) / '.git'
+    if dot_git.is_file():
+        gitdir = dot_git.read_text().strip()
+        if gitdir.startswith('gitdir:'):
+            return Path(path) / gitdir[len('gitdir:'):].strip()
+    return dot_git
+
+def common_dir(gitdir):
+    '''
+    returns the directory holding config and refs shared by all worktrees of gitdir
+    '''
+    try:
+        return gitdir / (gitdir / 'commondir').read_text().strip()
+    except OSError:
+        return gitdir
+
+def read_head(path):
+    '''
+    returns content of the HEAD file of the git repository at path or None
+    '''
+    try:
+        return (git_dir(path) / 'HEAD').read_text().strip()
+    except OSError:
+        return None
+
+def read_commit(path):
+    '''
+    returns the commit checked out in the git repository at path, resolving HEAD through loose and packed refs, or None
+    '''
+    head = read_head(path)
+    if not head or not head.startswith('ref: '):
+        # detached HEAD names the commit itself
+        return head
+    ref = head[len('ref: '):]
+    gitdir = git_dir(path)
+    for d in (gitdir, common_dir(gitdir)):
+        try:
+            return (d / ref).read_text().strip()
+        except OSError:
+            pass
+    try:
+        with open(common_dir(gitdir) / 'packed-refs') as f:
+            for line in f:
+                commit, _, name = line.rstrip('\n').partition(' ')
+                if name == ref:
+                    return commit
+    except OSError:
+        pass
+    return None
+
+class UnsupportedConfig(Exception):
+    pass
+
+SECTION = re.compile(r'\[\s*([A-Za-z0-9.-]+)(?:\s+"((?:[^"\\]|\\.)*)")?\s*\]\s*(?:[#;].*)?$')
+VARIABLE = re.compile(r'([A-Za-z][A-Za-z0-9-]*)\s*(?:=\s*(.*))?$')
+
+def parse_config(filename):
+    '''
+    returns {(section, subsection): {key: value}} of a git config file
+    Raises UnsupportedConfig for anything this minimal parser does not handle the way git does.
+    '''
+    config = {}
+    section = None
+    with open(filename) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line[0] in '#;':
+                continue
+            m = SECTION.match(line)
+            if m:
+                name, sub = m.group(1).lower(), m.group(2)
+                if sub is None and '.' in name:
+                    # legacy [section.subsection] syntax
+                    name, sub = name.split('.', 1)
+                if name in ('include', 'includeif'):
+                    raise UnsupportedConfig(f"{filename} includes other files")
+                section = config.setdefault((name, sub), {})
+                continue
+            m = VARIABLE.match(line)
+            if not m or section is None or (m.group(2) or '').endswith('\\'):
+                raise UnsupportedConfig(f"cannot parse '{line}' in {filename}")
+            value = (m.group(2) or 'true').strip()
+            if value.startswith('"') and value.endswith('"') and len(value) > 1:
+                value = value[1:-1]
+            elif '"' in value or '\\' in value or ' #' in value or ' ;' in value:
+                raise UnsupportedConfig(f"cannot parse '{line}' in {filename}")
+            section[m.group(1).lower()] = value
+    return config
+
+def user_configs():
+    '''
+    global and system config files, their url rewriting applies to all repositories
+    '''
+    home = Path(os.path.expanduser('~'))
+    xdg = Path(os.environ.get('XDG_CONFIG_HOME', home / '.config'))
+    return [Path('/etc/gitconfig'), xdg / 'git' / 'config', home / '.gitconfig']
+
+def call_git(path):
+    '''
+    returns (url, version) by asking git
+    '''
+    def call(cmd):
+        return profiling.run(cmd.split(" "), cwd=path).strip()
+    version = call('git symbolic-ref --short HEAD')
+    long_ref = call('git symbolic-ref -q HEAD')
+    remote = call(f'git for-each-ref --format=%(upstream:remotename) {long_ref}')
+    url = call(f'git remote get-url {remote}')
+    return url, version, remote
+
+def read_git(path):
+    '''
+    returns (url, version, remote) read from .git, or None if git has to be asked
+    '''
+    head = read_head(path)
+    if not head or not head.startswith('ref: refs/heads/'):
+        # detached HEAD or unreadable repository
+        return None
+    version = head[len('ref: refs/heads/'):]
+
+    gitdir = git_dir(path)
+    try:
+        configs = [parse_config(f) for f in user_configs() if f.is_file()]
+        config = parse_config(common_dir(gitdir) / 'config')
+    except (OSError, UnsupportedConfig):
+        return None
+    if any(k == 'insteadof' for c in configs + [config] for (name, _), s in c.items() if name == 'url' for k in s):
+        # urls are rewritten, only git knows the result
+        return None
+
+    branch = config.get(('branch', version), {})
+    remote = branch.get('remote', '') if 'merge' in branch else ''
+    if remote == '.':
+        # upstream is a local branch, git prints no remote name
+        return None
+    url = config.get(('remote', remote), {}).get('url', '') if remote else ''
+    return url, version, remote
+
+# session cache of get_git_info results by repository path
+_cache = {}
+
+def get_git_info(path):
+    '''
+    returns (url, version) of the branch checked out in the repository at path
+    url is the url of the remote of the upstream branch
+    '''
+    key = os.path.realpath(path)
+    if key not in _cache:
+        info = read_git(path) or call_git(path)
+        url, version, remote = info
+        if not remote:
+            print(f"ERROR: no remote found for {path}")
+        _cache[key] = (url, version)
+    return _cache[key]
+
+def get_git_infos(paths, jobs=16):
+    '''
+    returns get_git_info for all paths in order, using a thread pool
+    '''
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        return list(pool.map(get_git_info, paths))
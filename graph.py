@@ -0,0 +1,336 @@
+# compact dependency graph core used by workspace.py
+
+import numpy as np
+from collections import deque
+from typing import Dict, Iterable, List, Set, Tuple
+
+# dependency kinds tracked in a DependencyGraph
+KINDS = ('build', 'exec', 'test')
+
+def csr(n, src, dst):
+    '''
+    returns (indptr, indices, order) of the compressed sparse rows of edges src -> dst over n nodes
+    order maps the position of an edge in indices to its position in src/dst
+    '''
+    order = np.argsort(src, kind='stable')
+    indptr = np.zeros(n+1, dtype=np.int64)
+    np.cumsum(np.bincount(src, minlength=n), out=indptr[1:])
+    return indptr, dst[order].astype(np.int32), order
+
+class DependencyGraph:
+    '''
+    compact directed graph over interned names
+
+    Forward and reverse adjacency are stored as CSR arrays, one per dependency kind in KINDS.
+    Removing nodes or edges only clears entries in the `alive` masks, so the arrays never have to be rebuilt.
+    '''
+    def __init__(self, names: List[str], edges: Dict[str, Tuple[Iterable[int], Iterable[int]]]):
+        '''
+        names: node names, node ids are positions in this list
+        edges: (sources, targets) of the edges of each dependency kind
+        '''
+        self.names = list(names)
+        self.ids = {name: i for i, name in enumerate(self.names)}
+        n = len(self.names)
+
+        self.alive = np.ones(n, dtype=bool)
+
+        self.indptr = {}
+        self.indices = {}
+        self.sources = {}
+        self.edge_alive = {}
+        self.rindptr = {}
+        self.rindices = {}
+        # position of each reverse edge in the forward arrays, to share edge_alive
+        self.redges = {}
+        for kind in KINDS:
+            src, dst = edges.get(kind, ([], []))
+            src = np.asarray(src, dtype=np.int64)
+            dst = np.asarray(dst, dtype=np.int64)
+            self.indptr[kind], self.indices[kind], _ = csr(n, src, dst)
+            self.edge_alive[kind] = np.ones(len(src), dtype=bool)
+
+            # reverse adjacency is built from the forward layout, so order maps into the forward arrays
+            self.sources[kind] = np.repeat(np.arange(n, dtype=np.int32), np.diff(self.indptr[kind]))
+            self.rindptr[kind], self.rindices[kind], self.redges[kind] = csr(n, self.indices[kind].astype(np.int64), self.sources[kind])
+
+        # transitive closures and condensations by kinds, dropped whenever the graph changes
+        self.derived = {}
+
+    def __len__(self):
+        return len(self.names)
+
+    def successors(self, i: int, kind: str) -> np.ndarray:
+        '''
+        ids of live nodes i depends on through live edges of kind
+        '''
+        lo, hi = self.indptr[kind][i], self.indptr[kind][i+1]
+        targets = self.indices[kind][lo:hi]
+        return targets[self.edge_alive[kind][lo:hi] & self.alive[targets]]
+
+    def predecessors(self, i: int, kind: str) -> np.ndarray:
+        '''
+        ids of live nodes depending on i through live edges of kind
+        '''
+        lo, hi = self.rindptr[kind][i], self.rindptr[kind][i+1]
+        sources = self.rindices[kind][lo:hi]
+        return sources[self.edge_alive[kind][self.redges[kind][lo:hi]] & self.alive[sources]]
+
+    def edges(self, kinds: Iterable[str] = KINDS) -> Tuple[np.ndarray, np.ndarray]:
+        '''
+        (sources, targets) of all live edges of the given kinds, edges of several kinds may repeat
+        '''
+        src = np.concatenate([self.sources[kind] for kind in kinds])
+        dst = np.concatenate([self.indices[kind] for kind in kinds])
+        live = np.concatenate([self.edge_alive[kind] for kind in kinds]) & self.alive[src] & self.alive[dst]
+        return src[live].astype(np.int64), dst[live].astype(np.int64)
+
+    def depends(self, i: int, kind: str) -> Set[str]:
+        return set(self.names[j] for j in self.successors(i, kind))
+
+    def closure(self, ids: Iterable[int], kinds: Iterable[str] = KINDS, reverse: bool = False) -> Set[int]:
+        '''
+        ids together with all live nodes they (transitively) depend on, or which depend on them if reverse is set
+        '''
+        neighbors = self.predecessors if reverse else self.successors
+        seen = set(ids)
+        pending = list(seen)
+        while pending:
+            i = pending.pop()
+            for kind in kinds:
+                for j in neighbors(i, kind).tolist():
+                    if j not in seen:
+                        seen.add(j)
+                        pending.append(j)
+        return seen
+
+    def reachability(self, kinds: Iterable[str] = KINDS) -> 'Reachability':
+        '''
+        transitive closure over the live edges of kinds, built on first use
+        '''
+        key = ('reachability', tuple(kinds))
+        if key not in self.derived:
+            src, dst = self.edges(kinds)
+            indptr, indices, _ = csr(len(self), src, dst)
+            self.derived[key] = Reachability(indptr.tolist(), indices.tolist())
+        return self.derived[key]
+
+    def condensation(self, kinds: Iterable[str] = KINDS) -> 'Condensation':
+        key = ('condensation', tuple(kinds))
+        if key not in self.derived:
+            self.derived[key] = Condensation(self, kinds)
+        return self.derived[key]
+
+    def longest_chain(self, i: int, kinds: Iterable[str] = KINDS) -> List[int]:
+        '''
+        a longest path of dependencies starting at i, counting the nodes of a dependency cycle once
+        The path includes the nodes it passes on its way through a cycle, so consecutive nodes are real dependencies.
+        '''
+        condensation = self.condensation(kinds)
+        component = condensation.component
+        if component[i] < 0:
+            return [i]
+
+        # longest chain below each reachable component, dependencies are numbered first
+        reachable = np.unique(component[members(self.reachability(kinds).descendants[i])]).tolist()
+        length = {}
+        below = {}
+        for c in reachable:
+            below[c] = max(condensation.dependencies(c).tolist(), key=lambda d: length[d], default=None)
+            length[c] = 1 + (length[below[c]] if below[c] is not None else 0)
+
+        path = [i]
+        c = below[component[i]]
+        while c is not None:
+            # prefer an edge leaving the last node, otherwise go through its dependency cycle
+            u = path[-1]
+            for v in [u] + condensation.components[component[u]]:
+                targets = [w for kind in kinds for w in self.successors(v, kind).tolist() if component[w] == c]
+                if targets:
+                    break
+            if v != u:
+                # every path between two nodes of a cycle stays inside it
+                path.extend(self.path(u, v, kinds)[1:])
+            path.append(min(targets))
+            c = below[c]
+        return path
+
+    def path(self, i: int, j: int, kinds: Iterable[str] = KINDS) -> List[int]:
+        '''
+        a shortest path of dependencies from i to j or None if i does not depend on j
+        '''
+        reachability = self.reachability(kinds)
+        if not reachability.descendants[i] >> j & 1:
+            return None
+        # only follow edges to nodes which still lead to j
+        towards = reachability.ancestors[j]
+        parent = {i: None}
+        pending = deque([i])
+        while j not in parent:
+            v = pending.popleft()
+            for kind in kinds:
+                for w in self.successors(v, kind).tolist():
+                    if w not in parent and towards >> w & 1:
+                        parent[w] = v
+                        pending.append(w)
+        path = [j]
+        while parent[path[-1]] is not None:
+            path.append(parent[path[-1]])
+        return path[::-1]
+
+    def remove_node(self, i: int):
+        self.alive[i] = False
+        self.derived.clear()
+
+    def remove_edges(self, i: int, kind: str, targets: Iterable[int]):
+        '''
+        remove the edges of kind from i to any of targets in O(degree(i))
+        '''
+        lo, hi = self.indptr[kind][i], self.indptr[kind][i+1]
+        self.edge_alive[kind][lo:hi] &= ~np.isin(self.indices[kind][lo:hi], np.fromiter(targets, dtype=np.int32))
+        self.derived.clear()
+
+def strongly_connected_components(indptr: List[int], indices: List[int], roots: Iterable[int]) -> List[List[int]]:
+    '''
+    iterative Tarjan over the CSR adjacency (indptr, indices), visiting all nodes reachable from roots
+
+    Components are returned in reverse topological order, i.e., a component comes after
+    all components it has edges to.
+    '''
+    n = len(indptr) - 1
+    index = [-1] * n
+    low = [0] * n
+    on_stack = [False] * n
+    stack = []
+    components = []
+    counter = 0
+    for root in roots:
+        if index[root] != -1:
+            continue
+        index[root] = low[root] = counter
+        counter += 1
+        stack.append(root)
+        on_stack[root] = True
+        # explicit DFS stack of (node, position of next edge to follow)
+        work = [(root, indptr[root])]
+        while work:
+            v, pos = work[-1]
+            if pos < indptr[v+1]:
+                work[-1] = (v, pos+1)
+                w = indices[pos]
+                if index[w] == -1:
+                    index[w] = low[w] = counter
+                    counter += 1
+                    stack.append(w)
+                    on_stack[w] = True
+                    work.append((w, indptr[w]))
+                elif on_stack[w] and index[w] < low[v]:
+                    low[v] = index[w]
+                continue
+
+            work.pop()
+            if work:
+                u = work[-1][0]
+                if low[v] < low[u]:
+                    low[u] = low[v]
+            if low[v] == index[v]:
+                component = []
+                while True:
+                    w = stack.pop()
+                    on_stack[w] = False
+                    component.append(w)
+                    if w == v:
+                        break
+                components.append(component)
+    return components
+
+class Condensation:
+    '''
+    DAG of the strongly connected components of the live part of a DependencyGraph
+
+    Components are numbered in topological order, dependencies first.
+    Edges between components are stored as CSR arrays in both directions.
+    '''
+    def __init__(self, graph: DependencyGraph, kinds: Iterable[str] = KINDS):
+        n = len(graph)
+        src, dst = graph.edges(kinds)
+        indptr, indices, _ = csr(n, src, dst)
+        self.components = strongly_connected_components(indptr.tolist(), indices.tolist(), np.flatnonzero(graph.alive).tolist())
+
+        # component of each node, -1 for nodes which were not alive
+        self.component = np.full(n, -1, dtype=np.int64)
+        for c, ids in enumerate(self.components):
+            self.component[ids] = c
+
+        m = len(self.components)
+        csrc, cdst = self.component[src], self.component[dst]
+        pairs = np.unique((csrc * m + cdst)[csrc != cdst])
+        csrc, cdst = pairs // m, pairs % m
+        self.indptr, self.indices, _ = csr(m, csrc, cdst)
+        self.rindptr, self.rindices, _ = csr(m, cdst, csrc)
+
+    def __len__(self):
+        return len(self.components)
+
+    def dependencies(self, c: int) -> np.ndarray:
+        return self.indices[self.indptr[c]:self.indptr[c+1]]
+
+    def dependents(self, c: int) -> np.ndarray:
+        return self.rindices[self.rindptr[c]:self.rindptr[c+1]]
+
+    def in_degrees(self) -> np.ndarray:
+        '''
+        number of components each component depends on
+        '''
+        return np.diff(self.indptr)
+
+def bitset(ids: Iterable[int]) -> int:
+    bits = 0
+    for i in ids:
+        bits |= 1 << i
+    return bits
+
+def members(bits: int) -> List[int]:
+    '''
+    ids of the set bits, ascending
+    '''
+    return [i for i, b in enumerate(reversed(bin(bits)[2:])) if b == '1']
+
+def transitive_closure(indptr: List[int], indices: List[int]) -> List[int]:
+    '''
+    bitset of the nodes reachable from each node (including itself) of the CSR adjacency (indptr, indices)
+    '''
+    reach = [0] * (len(indptr) - 1)
+    # components come after all components they have edges to, so their reach is final when needed
+    for component in strongly_connected_components(indptr, indices, range(len(reach))):
+        bits = bitset(component)
+        for v in component:
+            for w in indices[indptr[v]:indptr[v+1]]:
+                bits |= reach[w]
+        for v in component:
+            reach[v] = bits
+    return reach
+
+class Reachability:
+    '''
+    transitive closure of a directed graph in both directions as one Python int bitset per node
+
+    Bit j of descendants[i] is set if j is reachable from i, bit j of ancestors[i] if i is reachable from j.
+    Every node reaches itself.
+    '''
+    def __init__(self, indptr: List[int], indices: List[int]):
+        n = len(indptr) - 1
+        self.descendants = transitive_closure(indptr, indices)
+        src = np.repeat(np.arange(n, dtype=np.int64), np.diff(indptr))
+        rindptr, rindices, _ = csr(n, np.asarray(indices, dtype=np.int64), src)
+        self.ancestors = transitive_closure(rindptr.tolist(), rindices.tolist())
+
+    def reachable(self, bits: int, reverse: bool = False) -> int:
+        '''
+        bitset of all nodes reachable from any node in bits, or which reach any of them if reverse is set
+        '''
+        closure = self.ancestors if reverse else self.descendants
+        reach = 0
+        for i in members(bits):
+            reach |= closure[i]
+        return reach
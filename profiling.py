@@ -0,0 +1,152 @@
+# optional instrumentation of the workspace tools, enabled with --profile
+
+import atexit
+import contextlib
+import cProfile
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+
+class Profiler:
+    '''
+    records spans of named phases as Chrome trace events (chrome://tracing, Perfetto)
+
+    Every span of the main thread also records the peak of memory allocated by Python (tracemalloc)
+    while it was open, nested spans included. With cprofile set, each top level span of the main thread
+    is run under cProfile and the statistics of the slowest one are kept.
+    '''
+    def __init__(self, trace_memory=True, cprofile=False):
+        self.events = []
+        self.origin = time.perf_counter()
+        self.trace_memory = trace_memory
+        self.cprofile = cprofile
+        # open spans of the main thread: [name, peak of finished children]
+        self.stack = []
+        self.slowest = None
+        self.lock = threading.Lock()
+        if trace_memory:
+            tracemalloc.start()
+
+    def add(self, name, category, start, end, **args):
+        with self.lock:
+            self.events.append({
+                'name': name,
+                'cat': category,
+                'ph': 'X',
+                'ts': (start - self.origin) * 1e6,
+                'dur': (end - start) * 1e6,
+                'pid': os.getpid(),
+                'tid': threading.get_ident(),
+                'args': args,
+                })
+
+    @contextlib.contextmanager
+    def span(self, name, category='phase', **args):
+        if threading.current_thread() is not threading.main_thread():
+            start = time.perf_counter()
+            try:
+                yield
+            finally:
+                self.add(name, category, start, time.perf_counter(), **args)
+            return
+
+        if self.trace_memory:
+            # the peak so far belongs to the enclosing span, the new span measures from here
+            if self.stack:
+                self.stack[-1][1] = max(self.stack[-1][1], tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+        profile = cProfile.Profile() if self.cprofile and not self.stack else None
+        self.stack.append([name, 0])
+        start = time.perf_counter()
+        if profile:
+            profile.enable()
+        try:
+            yield
+        finally:
+            if profile:
+                profile.disable()
+            end = time.perf_counter()
+            _, children = self.stack.pop()
+            if self.trace_memory:
+                peak = max(tracemalloc.get_traced_memory()[1], children)
+                if self.stack:
+                    self.stack[-1][1] = max(self.stack[-1][1], peak)
+                args['peak_memory'] = peak
+            self.add(name, category, start, end, **args)
+            if profile and (self.slowest is None or end - start > self.slowest[1]):
+                self.slowest = (name, end - start, profile)
+
+    def run(self, cmd, **kwargs):
+        '''
+        returns stdout of cmd, recording its runtime and peak resident memory
+        '''
+        start = time.perf_counter()
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, text=True, **kwargs)
+        stdout = proc.stdout.read()
+        proc.stdout.close()
+        # wait4 is the only way to get the resource usage of this particular child
+        _, status, usage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        self.add(' '.join(cmd), 'subprocess', start, time.perf_counter(), cwd=str(kwargs.get('cwd', '')), max_rss=usage.ru_maxrss * 1024)
+        return stdout
+
+    def write(self, filename):
+        with open(filename, 'w') as f:
+            json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, f)
+        # spans of the same name are summed up, in order of their first occurrence
+        phases = {}
+        for e in sorted(self.events, key=lambda e: e['ts']):
+            if e['cat'] != 'subprocess':
+                count, duration, peak = phases.get(e['name'], (0, 0, 0))
+                phases[e['name']] = (count + 1, duration + e['dur'], max(peak, e['args'].get('peak_memory', 0)))
+        for name, (count, duration, peak) in phases.items():
+            times = f" ({count} times)" if count > 1 else ''
+            memory = f", peak memory {peak / 2**20:.1f} MiB" if self.trace_memory else ''
+            print(f"profile: {name}: {duration / 1e6:.3f}s{times}{memory}", file=sys.stderr)
+        calls = [e for e in self.events if e['cat'] == 'subprocess']
+        if calls:
+            print(f"profile: {len(calls)} subprocesses: {sum(e['dur'] for e in calls) / 1e6:.3f}s", file=sys.stderr)
+        if self.slowest:
+            name, _, profile = self.slowest
+            profile.dump_stats(filename + '.prof')
+            print(f"profile: cProfile statistics of {name} written to {filename}.prof", file=sys.stderr)
+        print(f"profile: trace written to {filename}", file=sys.stderr)
+
+# the active Profiler, None unless profiling is enabled
+profiler = None
+
+def enable(filename, trace_memory=True, cprofile=False):
+    '''
+    start profiling and write the trace to filename when the program exits
+    '''
+    global profiler
+    profiler = Profiler(trace_memory, cprofile)
+    atexit.register(profiler.write, filename)
+
+def span(name, category='phase', **args):
+    '''
+    context manager recording name if profiling is enabled
+    '''
+    return profiler.span(name, category, **args) if profiler else contextlib.nullcontext()
+
+def run(cmd, **kwargs):
+    '''
+    subprocess.run(cmd, stdout=PIPE, text=True, **kwargs).stdout, recorded if profiling is enabled
+    '''
+    if profiler:
+        return profiler.run(cmd, **kwargs)
+    return subprocess.run(cmd, stdout=subprocess.PIPE, text=True, **kwargs).stdout
+
+def add_arguments(parser):
+    parser.add_argument('--profile', metavar='FILE',
+                        help="write time and peak memory of every phase and git call as Chrome trace (chrome://tracing) to FILE")
+    parser.add_argument('--profile-cprofile', action='store_true',
+                        help="with --profile: also write cProfile statistics of the slowest phase to FILE.prof")
+
+def enable_from_arguments(args):
+    if args.profile:
+        enable(args.profile, cprofile=args.profile_cprofile)
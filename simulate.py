@@ -0,0 +1,133 @@
+# discrete-event simulation of CI pipelines of sbuild jobs and tuning of their worker counts
+
+import heapq
+import numpy as np
+from dataclasses import dataclass
+from typing import Dict, List, NamedTuple, Sequence
+
+@dataclass
+class Runners:
+    '''
+    CI runners jobs are executed on, times are in units of the repository costs
+    '''
+    # until a runner picks up a job and has the build environment ready
+    startup: float = 0
+    # restoring caches (apt archives, ccache) at the start of a job
+    restore: float = 0
+    # saving caches and artifacts at the end of a job
+    save: float = 0
+    # jobs running at the same time (github allows 20 for free accounts)
+    concurrency: int = 20
+
+    @property
+    def overhead(self) -> float:
+        return self.startup + self.restore + self.save
+
+class Simulation(NamedTuple):
+    makespan: float
+    # summed up time runners were busy, including overhead
+    runner_time: float
+    start: Dict[str, float]
+    finish: Dict[str, float]
+
+def simulate(jobs, costs: Dict[str, float], runners: Runners, staged: bool = True) -> Simulation:
+    '''
+    replay jobs (as returned by autosplit.plan) event by event on runners
+
+    staged: a job becomes ready once all jobs of the previous stage finished, otherwise once all its `needs` finished
+    Ready jobs start in plan order as soon as fewer than runners.concurrency jobs are running.
+    '''
+    duration = {j.name: runners.overhead + sum(costs[r] for r in j.repositories) for j in jobs}
+    order = {j.name: i for i, j in enumerate(jobs)}
+
+    dependents = {j.name: [] for j in jobs}
+    waiting = {}
+    if staged:
+        by_stage = {}
+        for j in jobs:
+            by_stage.setdefault(j.stage, []).append(j.name)
+        stages = sorted(by_stage)
+        for previous, stage in zip(stages, stages[1:]):
+            for name in by_stage[previous]:
+                dependents[name].extend(by_stage[stage])
+            for name in by_stage[stage]:
+                waiting[name] = len(by_stage[previous])
+    else:
+        for j in jobs:
+            for n in j.needs or ():
+                dependents[n].append(j.name)
+            waiting[j.name] = len(j.needs or ())
+
+    ready = [order[j.name] for j in jobs if not waiting.get(j.name)]
+    heapq.heapify(ready)
+    running = []
+    start = {}
+    finish = {}
+    now = 0
+    while ready or running:
+        while ready and len(running) < runners.concurrency:
+            name = jobs[heapq.heappop(ready)].name
+            start[name] = now
+            heapq.heappush(running, (now + duration[name], order[name]))
+        now, i = heapq.heappop(running)
+        name = jobs[i].name
+        finish[name] = now
+        for d in dependents[name]:
+            waiting[d] -= 1
+            if waiting[d] == 0:
+                heapq.heappush(ready, order[d])
+
+    return Simulation(max(finish.values(), default=0), sum(duration.values()), start, finish)
+
+def list_schedule(durations: Sequence[float], runners: int) -> float:
+    '''
+    makespan of starting durations in order whenever one of runners is free
+    '''
+    if len(durations) <= runners:
+        return max(durations, default=0)
+    free = [0.0] * runners
+    for d in durations:
+        heapq.heappush(free, heapq.heappop(free) + d)
+    return max(free)
+
+def stage_options(loads: Sequence[Sequence[Sequence[float]]], runners: Runners):
+    '''
+    (time, runner time) of every stage for every option, arrays of shape (stages, options)
+
+    loads[s][o]: summed costs of the jobs of stage s with option o, an empty option is not available
+    '''
+    shape = (len(loads), max((len(o) for o in loads), default=0))
+    time = np.full(shape, np.inf)
+    runner_time = np.full(shape, np.inf)
+    for s, options in enumerate(loads):
+        for o, jobs in enumerate(options):
+            if jobs:
+                time[s, o] = list_schedule([runners.overhead + l for l in jobs], runners.concurrency)
+                runner_time[s, o] = sum(jobs) + len(jobs) * runners.overhead
+    return time, runner_time
+
+def sweep(time: np.ndarray, runner_time: np.ndarray, prices: np.ndarray):
+    '''
+    best option per stage when a unit of runner time is worth each of prices in units of makespan
+
+    Stages of a staged pipeline follow each other, so the choices are independent per stage
+    and all prices are evaluated at once.
+    Returns (choice of shape (prices, stages), makespan per price, runner time per price).
+    '''
+    objective = time[None, :, :] + prices[:, None, None] * runner_time[None, :, :]
+    choice = np.argmin(objective, axis=2)
+    stages = np.arange(time.shape[0])
+    return choice, time[stages, choice].sum(axis=1), runner_time[stages, choice].sum(axis=1)
+
+def cheapest(time: np.ndarray, runner_time: np.ndarray, slack: float, prices: int = 2000) -> List[int]:
+    '''
+    option per stage with the least runner time among plans within slack (e.g. 0.1) of the fastest one
+    '''
+    # prices relative to the ratio of time and runner time, the smallest ones only break ties
+    available = np.isfinite(time)
+    scale = time[available].max() / runner_time[available].max() if available.any() else 1
+    grid = np.geomspace(1e-6, 1e4, prices) * scale
+    choice, makespan, runner = sweep(time, runner_time, grid)
+    feasible = makespan <= makespan.min() * (1 + slack) + 1e-9
+    best = np.flatnonzero(feasible)[np.argmin(runner[feasible])]
+    return choice[best].tolist()
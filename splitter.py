@@ -1,39 +1,108 @@
 #!/usr/bin/env python
 # authored 2023 by Michael 'v4hn' Goerner
 
-import catkin_pkg.packages
+import argparse
+import bisect
+import catkin_pkg.package
+import json
+import numpy as np
+import profiling
+import shutil
 import sys
 import os
-import subprocess
 import cmd
-from collections import namedtuple
-from copy import deepcopy
+from collections import defaultdict, namedtuple
 from pathlib import Path
 from typing import Dict, Set, List
+from buildtimes import BuildTimes
+from gitinfo import get_git_infos
+from graph import Reachability, bitset, csr, members, strongly_connected_components
+from watch import Watcher
+from workspace import RepositoryMap
 
-def get_repository(path):
+def complete_prefix(names, text):
     '''
-    returns path to root of git repository containing path
+    entries of the sorted list names starting with text, by binary search
     '''
-    while not (path / '.git').is_dir():
-        path = path.parent
-    return path.as_posix()
-
-def get_git_info(path):
-    def call(cmd):
-        return subprocess.run(
-            cmd.split(" "),
-            stdout=subprocess.PIPE,
-            cwd=path,
-            text=True
-            ).stdout.strip()
-    version = call('git symbolic-ref --short HEAD')
-    long_ref = call('git symbolic-ref -q HEAD')
-    remote = call(f'git for-each-ref --format=%(upstream:remotename) {long_ref}')
-    url = call(f'git remote get-url {remote}')
-    if not remote:
-        print(f"ERROR: no remote found for {path}")
-    return url, version
+    lo = bisect.bisect_left(names, text)
+    hi = bisect.bisect_left(names, text + '\U0010ffff')
+    return names[lo:hi]
+
+def partition(weights, edges, parts, imbalance=0.1, passes=10):
+    '''
+    split nodes 0..n-1, numbered in topological order (dependencies first), into parts <= n non-empty groups
+
+    Every edge (a, b) of a depending on b ends with part[a] >= part[b], so the groups form a DAG.
+    Starts from contiguous chunks, each cut at the remaining weight divided by the remaining groups,
+    and greedily moves single nodes to other groups as long as this reduces the number of edges
+    between groups, or keeps it and evens out the weight of the two groups, without pushing a group
+    beyond `imbalance` of the average weight.
+
+    edges: {(a, b): multiplicity}
+    returns the group of every node
+    '''
+    n = len(weights)
+    weights = np.asarray(weights, dtype=float).tolist()
+    total = sum(weights)
+    parts = min(parts, n)
+    if n == 0:
+        return []
+
+    # a chunk ends before the node whose weight center lies beyond its share of the remaining weight,
+    # but keeps at least one node for every later chunk
+    part = []
+    p, chunk, remaining = 0, 0.0, total
+    for v, w in enumerate(weights):
+        if part and part[-1] == p and p < parts - 1 and (
+                chunk + w / 2 > remaining / (parts - p) or n - v == parts - 1 - p):
+            remaining -= chunk
+            p, chunk = p + 1, 0.0
+        part.append(p)
+        chunk += w
+
+    deps = [[] for _ in range(n)]
+    rdeps = [[] for _ in range(n)]
+    for (a, b), m in edges.items():
+        deps[a].append((b, m))
+        rdeps[b].append((a, m))
+
+    load = [0.0] * parts
+    size = [0] * parts
+    for v, p in enumerate(part):
+        load[p] += weights[v]
+        size[p] += 1
+    cap = (1 + imbalance) * total / parts
+    floor = (1 - imbalance) * total / parts
+
+    for _ in range(passes):
+        moved = False
+        for v in range(n):
+            p, w = part[v], weights[v]
+            if size[p] == 1 or load[p] - w < floor:
+                continue
+            # groups v can move to without an edge pointing to a later group
+            lo = max((part[b] for b, _ in deps[v]), default=0)
+            hi = min((part[a] for a, _ in rdeps[v]), default=parts - 1)
+            if lo == hi:
+                continue
+            links = defaultdict(int)
+            for u, m in deps[v] + rdeps[v]:
+                links[part[u]] += m
+            # fewer edges between groups first, a smaller weight difference of the two groups second
+            best, key = p, (links[p], 0)
+            for t in range(lo, hi + 1):
+                if t != p and load[t] + w <= cap and (links[t], load[p] - load[t] - w) > key:
+                    best, key = t, (links[t], load[p] - load[t] - w)
+            if best != p:
+                part[v] = best
+                load[p] -= w
+                load[best] += w
+                size[p] -= 1
+                size[best] += 1
+                moved = True
+        if not moved:
+            break
+    return part
 
 class Interface(cmd.Cmd):
     intro = ''
@@ -41,71 +110,423 @@ class Interface(cmd.Cmd):
 
     def columnize(self, entries, columns= 0 ):
         if columns == 0:
-            columns = os.get_terminal_size().columns-1
+            columns = shutil.get_terminal_size().columns-1
         super().columnize(list(entries), columns)
 
-    def __init__(self, ws):
+    def __init__(self, ws, journal=None, watch=False):
         if ws.endswith('/'):
             ws = ws[:len(ws)-1]
         self.ws = ws
-        cut_prefix = 0 if ws == "." else len(ws)+1
-
-        # index of all packages in workspace
-        self.Pkg = namedtuple('Pkg', ['path', 'pkg', 'repository'])
-        self.pkgs = {
-            pkg['name']: self.Pkg(path, pkg, get_repository(Path(ws)/path)[cut_prefix:])
-            for (path, pkg) in catkin_pkg.packages.find_packages(ws).items()
-        }
-
-        # index of all repositories in workspace
-        self.Repository = namedtuple('Repository', ['name', 'path', 'packages', 'build_depends', 'exec_depends'])
-        self.repos= {}
-        repository_names = set([p.repository for p in self.pkgs.values()])
-        for name in repository_names:
-            pkgs = [p for p in self.pkgs.values() if p.repository == name]
-            self.repos[name] = self.Repository(
-                name,
-                get_repository(Path(pkgs[0].path)),
-                [pkg for pkg in self.pkgs.values() if pkg.repository == name],
-                set([self.pkgs[d.name].repository for pkg in pkgs for d in pkg.pkg['build_depends'] if d.name in self.pkgs]).difference([name]),
-                set([self.pkgs[d.name].repository for pkg in pkgs for d in pkg.pkg['exec_depends'] if d.name in self.pkgs]).difference([name])
-                )
+        with profiling.span('scan'):
+            self.repository_map = RepositoryMap(ws)
+        with profiling.span('parse'):
+            # the packages RepositoryMap found, instead of traversing the workspace again
+            found = {path: catkin_pkg.package.parse_package(os.path.join(ws, path)) for path in self.repository_map.packages}
+
+        with profiling.span('repositories'):
+            # index of all packages in workspace
+            self.Pkg = namedtuple('Pkg', ['path', 'pkg', 'repository'])
+            self.pkgs = {
+                pkg['name']: self.Pkg(path, pkg, self.repository_map.get_repository(path))
+                for (path, pkg) in found.items()
+            }
+
+            # index of all repositories in workspace
+            self.Repository = namedtuple('Repository', ['name', 'path', 'packages', 'build_depends', 'exec_depends'])
+            self.repos= {}
+            repository_pkgs = defaultdict(list)
+            for pkg in self.pkgs.values():
+                repository_pkgs[pkg.repository].append(pkg)
+            for name, pkgs in repository_pkgs.items():
+                self.repos[name] = self.repository(name, pkgs)
+
+            # static indexes: package names per repository, direct (reverse) dependencies, sorted names for completion
+            self.repo_packages = {r: [p.pkg['name'] for p in repo.packages] for r, repo in self.repos.items()}
+            self.deps = {r: repo.build_depends.union(repo.exec_depends) for r, repo in self.repos.items()}
+            self.rdeps = {r: set() for r in self.repos}
+            for r, deps in self.deps.items():
+                for d in deps:
+                    self.rdeps[d].add(r)
+            self.pkg_names = sorted(self.pkgs)
+            self.repo_names = sorted(self.repos)
+
+        self.index_repo_graph()
+        # mtime and size of every manifest, to find the modified ones on refresh
+        self.manifest_stats = self.stat_manifests(self.repository_map.packages)
+        # estimated build time per repository to balance groups by instead of package count
+        self.costs = None
 
         # map of build groups (multiple repositories build together)
-        self.groups = {'loose': repository_names}
+        self.groups = {'loose': set(self.repos)}
         # TODO: read them from *.repos in the folder
+        self.index_groups()
 
-        # keep history around to support undo
-        self.Frame = namedtuple('Frame', ['command', 'groups'])
+        # keep history around to support undo/redo
+        # every frame holds the primitive operations of a command and their inverses
+        self.Frame = namedtuple('Frame', ['command', 'ops', 'inverse'])
         self.history = []
+        self.future = []
+
+        # append-only log of the session, replayed on startup
+        self.journal = None
+        if journal:
+            with profiling.span('replay'):
+                complete = self.replay(journal)
+            self.journal = open(journal, 'a')
+            if not complete:
+                # start a new line after a torn write
+                self.journal.write("\n")
+
+        # notices changes of the workspace, which are picked up before the next command
+        self.watcher = Watcher(ws, self.repository_map.roots) if watch else None
 
         super().__init__(completekey='tab')
-        self.do_list("")
 
-    def push_frame(self, cmd):
+    def repository(self, name, pkgs):
+        return self.Repository(
+            name,
+            name,
+            pkgs,
+            set([self.pkgs[d.name].repository for pkg in pkgs for d in pkg.pkg['build_depends'] if d.name in self.pkgs]).difference([name]),
+            set([self.pkgs[d.name].repository for pkg in pkgs for d in pkg.pkg['exec_depends'] if d.name in self.pkgs]).difference([name])
+            )
+
+    def index_repo_graph(self):
         '''
-        push group state to history stack / has to be called *before* applying modification
+        rebuild the repository graph over positions in repo_names and its transitive closure
         '''
-        self.history.append(self.Frame(cmd, deepcopy(self.groups)))
+        self.repo_ids = {r: i for i, r in enumerate(self.repo_names)}
+        self.repo_edges = (
+            np.array([self.repo_ids[r] for r in self.repo_names for d in self.deps[r]], dtype=np.int64),
+            np.array([self.repo_ids[d] for r in self.repo_names for d in self.deps[r]], dtype=np.int64)
+            )
+        indptr, indices, _ = csr(len(self.repo_names), *self.repo_edges)
+        self.repo_graph = (indptr.tolist(), indices.tolist())
+        with profiling.span('reachability'):
+            self.reachability = Reachability(*self.repo_graph)
+
+    def stat_manifests(self, paths):
+        stats = {}
+        for path in paths:
+            try:
+                st = os.stat(os.path.join(self.ws, path, 'package.xml'))
+            except OSError:
+                continue
+            stats[path] = (st.st_mtime_ns, st.st_size)
+        return stats
+
+    def refresh(self):
+        '''
+        patch all indexes to match the packages and repositories on disk, keeping the groups
+        Only new and modified manifests are parsed, new repositories start out loose.
+        returns (packages parsed, repositories added, repositories removed, groups affected)
+        '''
+        self.repository_map = RepositoryMap(self.ws)
+        stats = self.stat_manifests(self.repository_map.packages)
+        names = {p.path: name for name, p in self.pkgs.items()}
+        modified = [path for path, st in stats.items() if self.manifest_stats.get(path) != st]
+        relocated = [path for path, name in names.items()
+                     if path in stats and path not in modified and self.repository_map.get_repository(path) != self.pkgs[name].repository]
+        removed = [path for path in names if path not in stats]
+        self.manifest_stats = stats
+
+        # packages which appear, disappear or change their repository
+        dropped = {names[path]: self.pkgs.pop(names[path]) for path in modified + relocated + removed if path in names}
+        inserted = []
+        for path in relocated:
+            pkg = dropped[names[path]]
+            self.pkgs[pkg.pkg['name']] = self.Pkg(path, pkg.pkg, self.repository_map.get_repository(path))
+            inserted.append(pkg.pkg['name'])
+        for path in modified:
+            try:
+                pkg = catkin_pkg.package.parse_package(os.path.join(self.ws, path))
+            except Exception as e:
+                print(f"WARNING: ignoring {path}: {e}")
+                continue
+            if pkg['name'] in self.pkgs:
+                print(f"WARNING: ignoring {path}: package '{pkg['name']}' already found in {self.pkgs[pkg['name']].path}")
+                continue
+            self.pkgs[pkg['name']] = self.Pkg(path, pkg, self.repository_map.get_repository(path))
+            inserted.append(pkg['name'])
+        moved = set(name for name, pkg in dropped.items() if name not in self.pkgs or self.pkgs[name].repository != pkg.repository)
+        moved.update(name for name in inserted if name not in dropped)
+
+        # repositories of changed packages and of packages depending on packages which moved
+        touched = set(pkg.repository for pkg in dropped.values())
+        touched.update(self.pkgs[name].repository for name in inserted)
+        for pkg in self.pkgs.values():
+            if moved.intersection(d.name for d in pkg.pkg['build_depends'] + pkg.pkg['exec_depends']):
+                touched.add(pkg.repository)
+        if not touched:
+            return [], [], [], []
+        repository_pkgs = defaultdict(list)
+        for pkg in self.pkgs.values():
+            if pkg.repository in touched:
+                repository_pkgs[pkg.repository].append(pkg)
+
+        repos = {r: self.repository(r, repository_pkgs[r]) for r in touched if r in repository_pkgs}
+        added = sorted(set(repos).difference(self.repos))
+        gone = sorted(touched.difference(repos).intersection(self.repos))
+        deps = {r: repo.build_depends.union(repo.exec_depends) for r, repo in repos.items()}
+        old_edges = set((r, d) for r in touched if r in self.deps for d in self.deps[r])
+        new_edges = set((r, d) for r, ds in deps.items() for d in ds)
+        affected = set(self.repo_group[r] for r in touched if r in self.repo_group)
+
+        for r, d in old_edges - new_edges:
+            affected.add(self.repo_group[d])
+            self.unlink(r, d)
+            self.rdeps[d].discard(r)
+        for r in touched.intersection(self.repos):
+            self.group_packages[self.repo_group[r]].difference_update(self.repo_packages[r])
+        for r in gone:
+            self.groups[self.repo_group.pop(r)].remove(r)
+            del self.repos[r], self.repo_packages[r], self.deps[r], self.rdeps[r]
+        for r in added:
+            self.groups['loose'].add(r)
+            self.repo_group[r] = 'loose'
+            self.rdeps[r] = set()
+            affected.add('loose')
+        for r, repo in repos.items():
+            self.repos[r] = repo
+            self.repo_packages[r] = [p.pkg['name'] for p in repo.packages]
+            self.deps[r] = deps[r]
+            self.group_packages[self.repo_group[r]].update(self.repo_packages[r])
+        for r, d in new_edges - old_edges:
+            self.link(r, d)
+            self.rdeps[d].add(r)
+            affected.add(self.repo_group[d])
+
+        self.pkg_names = sorted(self.pkgs)
+        self.repo_names = sorted(self.repos)
+        if added or gone or old_edges != new_edges:
+            self.index_repo_graph()
+        return sorted(modified), added, gone, sorted(affected)
+
+    def report_refresh(self):
+        parsed, added, gone, affected = self.refresh()
+        if self.watcher:
+            self.watcher.update(self.repository_map.roots)
+        if not affected:
+            return
+        print(f"workspace changed: {len(parsed)} manifests parsed" +
+              (f", new repositories: {' '.join(added)}" if added else "") +
+              (f", removed repositories: {' '.join(gone)}" if gone else ""))
+        print(f"affected groups: {' '.join(affected)}")
+        reported = set()
+        for g in affected:
+            cycle = self.group_cycle(g) if g not in reported else None
+            if cycle:
+                reported.update(cycle)
+                print(f"WARNING: cycle between groups {' -> '.join(cycle)}")
+
+    def index_groups(self):
+        '''
+        rebuild all indexes derived from self.groups
+        '''
+        self.group_names = sorted(self.groups)
+        # group of each repository
+        self.repo_group = {r: g for g, repos in self.groups.items() for r in repos}
+        # package names of each group
+        self.group_packages = {g: set(p for r in repos for p in self.repo_packages[r]) for g, repos in self.groups.items()}
+        # group dependency multigraph: group_edges[g][h] holds every (repo, dep) with repo in g depending on dep in h != g
+        self.group_edges = {g: {} for g in self.groups}
+        for r, deps in self.deps.items():
+            for d in deps:
+                self.link(r, d)
+
+    def link(self, repo, dep):
+        g, h = self.repo_group[repo], self.repo_group[dep]
+        if g != h:
+            self.group_edges[g].setdefault(h, set()).add((repo, dep))
+
+    def unlink(self, repo, dep):
+        g, h = self.repo_group[repo], self.repo_group[dep]
+        if g != h:
+            edges = self.group_edges[g][h]
+            edges.remove((repo, dep))
+            if not edges:
+                del self.group_edges[g][h]
+
+    def relocate(self, repo, group):
+        '''
+        move repo to group and update the indexes in O(degree of repo + packages of repo)
+        returns the previous group of repo
+        '''
+        old_group = self.repo_group[repo]
+        edges = [(repo, d) for d in self.deps[repo]] + [(r, repo) for r in self.rdeps[repo]]
+        for r, d in edges:
+            self.unlink(r, d)
+
+        self.groups[old_group].remove(repo)
+        self.group_packages[old_group].difference_update(self.repo_packages[repo])
+        self.groups[group].add(repo)
+        self.group_packages[group].update(self.repo_packages[repo])
+        self.repo_group[repo] = group
+
+        for r, d in edges:
+            self.link(r, d)
+        return old_group
+
+    def apply(self, op):
+        '''
+        apply a primitive operation on the groups and return its inverse
+
+        ('move', repo, group), ('create', group), ('delete', group) of an empty group, ('rename', old, new)
+        '''
+        kind, *args = op
+        if kind == 'move':
+            repo, group = args
+            if repo not in self.repos:
+                # the repository disappeared from the workspace since
+                return op
+            return ('move', repo, self.relocate(repo, group))
+        if kind == 'create':
+            group, = args
+            self.groups[group] = set()
+            self.group_packages[group] = set()
+            self.group_edges[group] = {}
+            bisect.insort(self.group_names, group)
+            return ('delete', group)
+        if kind == 'delete':
+            group, = args
+            assert not self.groups[group], f"group '{group}' is not empty"
+            del self.groups[group]
+            del self.group_packages[group]
+            del self.group_edges[group]
+            self.group_names.remove(group)
+            return ('create', group)
+        if kind == 'rename':
+            old, new = args
+            self.groups[new] = self.groups.pop(old)
+            self.group_packages[new] = self.group_packages.pop(old)
+            self.group_edges[new] = self.group_edges.pop(old)
+            for edges in self.group_edges.values():
+                if old in edges:
+                    edges[new] = edges.pop(old)
+            for repo in self.groups[new]:
+                self.repo_group[repo] = new
+            self.group_names.remove(old)
+            bisect.insort(self.group_names, new)
+            return ('rename', new, old)
+        raise ValueError(f"unknown operation {op}")
+
+    def applicable(self, ops):
+        '''
+        whether ops can be applied in sequence on the current groups
+        '''
+        groups = set(self.groups)
+        for kind, *args in ops:
+            if kind == 'move' and args[0] in self.repos and args[1] in groups:
+                continue
+            if kind == 'create' and args[0] not in groups:
+                groups.add(args[0])
+            elif kind == 'delete' and args[0] in groups:
+                groups.remove(args[0])
+            elif kind == 'rename' and args[0] in groups and args[1] not in groups and args[0] != 'loose':
+                groups.remove(args[0])
+                groups.add(args[1])
+            else:
+                return False
+        return True
+
+    def execute(self, command, ops):
+        '''
+        apply ops as one undoable command
+        '''
+        inverse = [self.apply(op) for op in ops][::-1]
+        self.history.append(self.Frame(command, ops, inverse))
+        self.future.clear()
+        self.log({'action': 'do', 'command': command, 'ops': ops})
+
+    def log(self, entry):
+        if self.journal:
+            self.journal.write(json.dumps(entry) + "\n")
+            self.journal.flush()
+
+    def replay(self, journal):
+        '''
+        restore the session recorded in journal
+        Commands which do not apply to the workspace anymore are kept in the history without effect.
+        returns whether the journal ends with a complete line
+        '''
+        try:
+            with open(journal) as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            return True
+
+        skipped = 0
+        for nr, line in enumerate(lines):
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # the last line may be incomplete if the session crashed while writing it
+                print(f"WARNING: ignoring corrupt line {nr+1} of journal {journal}")
+                continue
+            if entry['action'] == 'do':
+                ops = [tuple(op) for op in entry['ops']]
+                if not self.applicable(ops):
+                    skipped += 1
+                    ops = []
+                self.execute(entry['command'], ops)
+            elif entry['action'] == 'undo' and self.history:
+                self.undo()
+            elif entry['action'] == 'redo' and self.future:
+                self.redo()
+        print(f"replayed {len(self.history)} commands from journal {journal}" + (f" ({skipped} do not apply anymore)" if skipped else ""))
+        return not lines or lines[-1].endswith("\n")
+
+    def undo(self):
+        frame = self.history.pop()
+        for op in frame.inverse:
+            self.apply(op)
+        self.future.append(frame)
+        self.log({'action': 'undo'})
+        return frame
+
+    def redo(self):
+        frame = self.future.pop()
+        for op in frame.ops:
+            self.apply(op)
+        self.history.append(frame)
+        self.log({'action': 'redo'})
+        return frame
 
     def do_undo(self, line):
         if len(self.history) == 0:
             print ("nothing to undo")
             return
 
-        print(f"undoing `{self.history[-1].command}`")
-        self.groups = self.history[-1].groups
-        self.history.pop()
+        print(f"undoing `{self.undo().command}`")
+
+    def do_redo(self, line):
+        if len(self.future) == 0:
+            print ("nothing to redo")
+            return
+
+        print(f"redoing `{self.redo().command}`")
 
     def do_hist(self, line):
         for i,frame in enumerate(self.history[::-1]):
             print(f"({i:02}) {frame.command}")
 
+    def onecmd(self, line):
+        with profiling.span(line.split(' ')[0] or 'empty', category='command', line=line):
+            return super().onecmd(line)
+
     def precmd(self, line):
         if line == 'EOF':
             sys.exit(0)
+        if self.watcher and self.watcher.changed():
+            self.report_refresh()
         return line
 
+    def do_refresh(self, line):
+        '''
+        pick up new, removed and modified packages and repositories, `--watch` does this before every command
+        '''
+        self.report_refresh()
+
     def complete_ls(self, text, line, begidx, endidx):
         return self.complete_list(text, line, begidx, endidx)
 
@@ -114,7 +535,7 @@ class Interface(cmd.Cmd):
         self.do_list(line)
 
     def complete_list(self, text, line, begidx, endidx):
-        return [g for g in self.groups.keys() if g.startswith(text)]
+        return complete_prefix(self.group_names, text)
 
     def do_list(self, line):
         """
@@ -133,7 +554,7 @@ class Interface(cmd.Cmd):
             print(f"group {g}:\n")
             print(f'{len(self.groups[g])} repositories:')
             self.columnize(self.groups[g])
-            pkgs = set([p.pkg['name'] for p in self.pkgs.values() if p.repository in self.groups[g]])
+            pkgs = self.group_packages[g]
             print(f'\n{len(pkgs)} packages:')
             self.columnize(pkgs)
             print()
@@ -143,10 +564,10 @@ class Interface(cmd.Cmd):
         list all groups with statistics
         '''
         for g in self.groups:
-            print(f"{g}: {len(self.groups[g])} repositories / {len([p for r in self.groups[g] for p in self.repos[r].packages])} packages")
+            print(f"{g}: {len(self.groups[g])} repositories / {len(self.group_packages[g])} packages")
 
     def complete_pkg(self, text, line, begidx, endidx):
-        return [p for p in self.pkgs if p.startswith(text)]
+        return complete_prefix(self.pkg_names, text)
 
     def do_pkg(self, pkg_name):
         "Inspect a package showing its dependencies and repository"
@@ -175,7 +596,7 @@ class Interface(cmd.Cmd):
         print()
 
     def complete_repo(self, text, line, begidx, endidx):
-        return [r for r in self.repos if r.startswith(text)]
+        return complete_prefix(self.repo_names, text)
 
     def do_repo(self, repo_name):
         '''
@@ -189,7 +610,7 @@ class Interface(cmd.Cmd):
 
         print("group\n"
               "-----")
-        print(next(g for g in self.groups if repo_name in self.groups[g]))
+        print(self.repo_group[repo_name])
 
         print("\npackages\n"
               "--------")
@@ -205,11 +626,10 @@ class Interface(cmd.Cmd):
 
         print("\ndirect rdeps\n"
                 "------------")
-        rdeps = [r for r in self.repos if repo_name in self.repos[r].build_depends.union(self.repos[r].exec_depends)]
-        self.columnize(rdeps)
+        self.columnize(self.rdeps[repo_name])
 
     def complete_group(self, text, line, begidx, endidx):
-        return [g for g in self.groups if g.startswith(text)]
+        return complete_prefix(self.group_names, text)
 
     def do_group(self, group):
         '''
@@ -225,13 +645,12 @@ class Interface(cmd.Cmd):
 
         self.columnize(self.groups[group])
 
-        repo_deps = [(dep, repo) for repo in self.groups[group] for dep in self.repos[repo].build_depends.union(self.repos[repo].exec_depends)]
-        group_deps = {g : (dep, repo) for g in self.groups if g != group for repo,dep in repo_deps if repo in self.groups[g]}
         print("\ndependencies\n"
               "------------")
 
-        for d in set(group_deps):
-            print(f"{d} (e.g., {group_deps[d][0]} depends on {group_deps[d][1]})")
+        for d, edges in sorted(self.group_edges[group].items()):
+            repo, dep = min(edges)
+            print(f"{d} (e.g., {repo} depends on {dep}, {len(edges)} dependencies)")
 
     def do_create(self, group):
         '''
@@ -241,13 +660,11 @@ class Interface(cmd.Cmd):
             print(f"group '{group}' already exists")
             return
 
-        self.push_frame(f"create {group}")
-
-        self.groups[group] = set()
+        self.execute(f"create {group}", [('create', group)])
         print(f"Created group '{group}'")
 
     def complete_remove(self, text, line, begidx, endidx):
-        return [g for g in self.groups if g.startswith(text) and g != 'loose']
+        return [g for g in complete_prefix(self.group_names, text) if g != 'loose']
 
     def do_remove(self, group):
         '''
@@ -255,9 +672,13 @@ class Interface(cmd.Cmd):
         '''
         if group not in self.groups:
             print(f"group '{group}' does not exist")
+            return
 
-        self.groups['loose'].update(self.groups[group])
-        del self.groups[group]
+        if group == 'loose':
+            print("group 'loose' cannot be removed")
+            return
+
+        self.execute(f"remove {group}", [('move', repo, 'loose') for repo in sorted(self.groups[group])] + [('delete', group)])
         print(f"group '{group}' removed (repositories loose again)")
 
     def complete_rename(self, text, line, begidx, endidx):
@@ -274,10 +695,15 @@ class Interface(cmd.Cmd):
             print(f"group '{old}' does not exist")
             return
 
-        self.push_frame(f"rename {old} {new}")
+        if old == 'loose':
+            print("group 'loose' cannot be renamed")
+            return
+
+        if new in self.groups:
+            print(f"group '{new}' already exists")
+            return
 
-        self.groups[new] = self.groups[old]
-        del self.groups[old]
+        self.execute(f"rename {old} {new}", [('rename', old, new)])
         print(f"group '{old}' renamed to '{new}'")
 
     def complete_mv(self, text, line, begidx, endidx):
@@ -290,15 +716,98 @@ class Interface(cmd.Cmd):
     def complete_move(self, text, line, begidx, endidx):
         if len(line.split(" ")) == 2:
             return self.complete_repo(text, line, begidx, endidx)
-        else:
+        elif len(line.split(" ")) == 3:
             return self.complete_group(text, line, begidx, endidx)
+        else:
+            return [f for f in ['deps', 'preview', 'rdeps'] if f.startswith(text)]
+
+    def reaching(self, group, reverse=False):
+        '''
+        groups group (transitively) depends on ignoring 'loose', or which depend on group if reverse is set
+        '''
+        if reverse:
+            edges = defaultdict(list)
+            for g, deps in self.group_edges.items():
+                for h in deps:
+                    edges[h].append(g)
+        else:
+            edges = self.group_edges
+        seen = {group}
+        pending = [group]
+        while pending:
+            for h in edges[pending.pop()]:
+                if h != 'loose' and h not in seen:
+                    seen.add(h)
+                    pending.append(h)
+        seen.remove(group)
+        return seen
+
+    def group_bits(self, groups):
+        return bitset(self.repo_ids[r] for g in groups for r in self.groups[g])
+
+    def move_along(self, repo, group, deps, rdeps):
+        '''
+        repositories to move to group together with repo, repo first, so that no cycle through group forms
+        deps: move (transitive) dependencies of group which are in groups depending on group
+        rdeps: move (transitive) dependents of group which are in groups group depends on
+        '''
+        moving = [repo]
+        inverse = [self.apply(('move', repo, group))]
+        bits = self.group_bits([group])
+        descendants = self.reachability.reachable(bits) if deps else 0
+        ancestors = self.reachability.reachable(bits, reverse=True) if rdeps else 0
+        while group != 'loose':
+            along = 0
+            if deps:
+                along |= descendants & self.group_bits(self.reaching(group, reverse=True))
+            if rdeps:
+                along |= ancestors & self.group_bits(self.reaching(group))
+            if not along:
+                break
+            if deps:
+                descendants |= self.reachability.reachable(along)
+            if rdeps:
+                ancestors |= self.reachability.reachable(along, reverse=True)
+            for j in members(along):
+                moving.append(self.repo_names[j])
+                inverse.append(self.apply(('move', self.repo_names[j], group)))
+        for op in inverse[::-1]:
+            self.apply(op)
+        return moving
+
+    def group_cycle(self, group):
+        '''
+        groups of a dependency cycle from group back to group ignoring 'loose', or None
+        '''
+        if group == 'loose':
+            return None
+        parent = {group: None}
+        pending = [group]
+        while pending:
+            g = pending.pop()
+            for h in self.group_edges[g]:
+                if h == group:
+                    cycle = [g]
+                    while cycle[-1] != group:
+                        cycle.append(parent[cycle[-1]])
+                    return cycle[::-1] + [group]
+                if h != 'loose' and h not in parent:
+                    parent[h] = g
+                    pending.append(h)
+        return None
 
     def do_move(self, line):
         '''
-        `move <repo> <group>` to move a repository from anywhere to <group>
-        Maintain dependency hierarchy - possibly moving other packages along
+        `move <repo> <group> [deps] [rdeps] [preview]` to move a repository from anywhere to <group>
+        Maintain dependency hierarchy - possibly moving other packages along:
+        `deps` moves (transitive) dependencies along which would otherwise form a cycle between groups,
+        `rdeps` dependents which would. `preview` only shows what would happen.
         '''
-        repo, new_group = line.split(" ")
+        repo, new_group, *flags = line.split()
+
+        if not set(flags).issubset(['deps', 'rdeps', 'preview']):
+            print("usage: move <repo> <group> [deps] [rdeps] [preview]")
+            return
 
         if new_group not in self.groups:
             print(f"group '{new_group}' is not known")
@@ -312,25 +821,81 @@ class Interface(cmd.Cmd):
             print(f"repository '{repo}' already in group '{new_group}'")
             return
 
-        self.push_frame(f"move {repo} {new_group}")
+        moving = self.move_along(repo, new_group, 'deps' in flags, 'rdeps' in flags)
+        ops = [('move', r, new_group) for r in moving]
 
-        old_group = next(g for g in self.groups if repo in self.groups[g])
+        if 'preview' in flags:
+            for r in moving:
+                print(f"would move {r} from {self.repo_group[r]} to {new_group}")
+            inverse = [self.apply(op) for op in ops][::-1]
+            cycle = self.group_cycle(new_group)
+            for op in inverse:
+                self.apply(op)
+        else:
+            for r in moving:
+                print(f"moved {r} from {self.repo_group[r]} to {new_group}")
+            self.execute(f"move {line}", ops)
+            cycle = self.group_cycle(new_group)
 
-        self.groups[old_group].remove(repo)
-        self.groups[new_group].add(repo)
+        if cycle:
+            print(f"WARNING: cycle between groups {' -> '.join(cycle)}")
+
+    def do_autogroup(self, line):
+        '''
+        `autogroup <N>` replace all groups by N groups
+        Groups follow the dependency direction (group i only depends on groups < i), keep
+        repositories with cyclic dependencies together, balance package count (or build cost
+        if a build time history was given) and keep the number of dependencies between groups small.
+        '''
+        try:
+            parts = int(line)
+            assert parts > 0
+        except (ValueError, AssertionError):
+            print("usage: autogroup <N>")
+            return
 
-        print(f"moved {repo} from {old_group} to {new_group}")
+        # components of repositories with cyclic dependencies in topological order
+        names = self.repo_names
+        src, dst = self.repo_edges
+        components = strongly_connected_components(*self.repo_graph, range(len(names)))
+        if parts > len(components):
+            print(f"cannot split {len(components)} repositories (or cycles of repositories) into {parts} groups")
+            return
+        component = np.empty(len(names), dtype=np.int64)
+        for c, ids in enumerate(components):
+            component[ids] = c
+
+        weight = self.costs if self.costs is not None else {r: len(self.repo_packages[r]) for r in names}
+        weights = [sum(weight.get(names[i], 0) for i in ids) for ids in components]
+        edges = defaultdict(int)
+        for a, b in zip(component[src].tolist(), component[dst].tolist()):
+            if a != b:
+                edges[(a, b)] += 1
+        part = partition(weights, edges, parts)
+
+        new_groups = [f"group{i}" for i in range(parts)]
+        ops = [('move', r, 'loose') for g in self.group_names if g != 'loose' for r in sorted(self.groups[g])]
+        ops += [('delete', g) for g in self.group_names if g != 'loose']
+        ops += [('create', g) for g in new_groups]
+        ops += [('move', names[i], new_groups[p]) for ids, p in zip(components, part) for i in sorted(ids)]
+        self.execute(f"autogroup {parts}", ops)
+
+        for g in new_groups:
+            print(f"{g}: {len(self.groups[g])} repositories / {len(self.group_packages[g])} packages / weight {sum(weight.get(r, 0) for r in self.groups[g]):.0f}")
+        print(f"{sum(len(e) for edges in self.group_edges.values() for e in edges.values())} dependencies between groups")
 
     def do_export(self, line):
         '''
         export groups to .repos files
         '''
+        ws= Path(self.ws)
+        repositories = [r for group in self.groups for r in self.groups[group]]
+        git_info = dict(zip(repositories, get_git_infos([ws/r for r in repositories])))
         for group in self.groups:
             with open(f'{group}.repos', 'w') as file:
                 file.write("repositories:\n")
-                ws= Path(self.ws)
                 for repository in self.groups[group]:
-                    url, version = get_git_info(ws/repository)
+                    url, version = git_info[repository]
                     file.write(
                         f"  {repository}:\n"
                         f"    type: git\n"
@@ -341,18 +906,37 @@ class Interface(cmd.Cmd):
 
         with open('repos_dependencies.txt', 'w') as file:
             for group in self.groups:
-                repo_deps = [(repo_dep, repo_group) for repo_group in self.groups[group] for repo_dep in self.repos[repo_group].build_depends.union(self.repos[repo_group].exec_depends)]
-                group_deps = {group_dep: (repo_dep, repo_group) for group_dep in self.groups if group_dep != group for (repo_dep, repo_group) in repo_deps if repo_dep in self.groups[group_dep]}
-                for group_dep in group_deps.keys():
-                    repo_dep, repo_group = group_deps[group_dep]
+                for group_dep, edges in sorted(self.group_edges[group].items()):
+                    repo_group, repo_dep = min(edges)
                     file.write(f"{group} depends on {group_dep} (e.g., {repo_group} depends on {repo_dep}))\n")
         print("wrote dependencies to repos_dependencies.txt")
 
     def find_all_pkg_in_repository(self, pkg):
-        return [n for (n,p) in self.pkgs.items() if p.repository == pkg.repository]
+        return self.repo_packages[pkg.repository]
 
 if __name__ == '__main__':
-    interface = Interface(sys.argv[1] if len(sys.argv) > 1 else ".")
+    parser = argparse.ArgumentParser(description="interactively split a workspace into groups of repositories")
+    parser.add_argument('workspace', nargs='?', default='.')
+    parser.add_argument('--journal', help="append the session to this file and replay it on startup")
+    parser.add_argument('--history', nargs='+', help="json/csv build time histories to balance groups by estimated build time")
+    parser.add_argument('--autogroup', type=int, metavar='N', help="split the workspace into N groups")
+    parser.add_argument('--export', action='store_true', help="export the groups and exit instead of starting the interactive session")
+    parser.add_argument('--watch', action='store_true', help="pick up changes of the workspace before every command (uses inotify_simple if installed, polling otherwise)")
+    profiling.add_arguments(parser)
+    args = parser.parse_args()
+    profiling.enable_from_arguments(args)
+
+    with profiling.span('startup'):
+        interface = Interface(args.workspace, journal=args.journal, watch=args.watch)
+    if args.history:
+        interface.costs = BuildTimes.load(*args.history).sized_costs({r: len(p) for r, p in interface.repo_packages.items()})
+    if args.autogroup:
+        interface.do_autogroup(str(args.autogroup))
+    if args.export:
+        interface.do_export("")
+        sys.exit(0)
+
+    interface.do_list("")
     while True:
         try:
             interface.cmdloop()
@@ -0,0 +1,94 @@
+# notices changes to the packages and repositories of a workspace, used by `splitter.py --watch`
+
+import sys
+import time
+from pathlib import Path
+from workspace import IGNORE_MARKERS
+
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+# entries whose creation, removal or modification can change packages or repositories
+RELEVANT = {'package.xml', '.git'} | IGNORE_MARKERS
+
+class Watcher:
+    '''
+    tells whether the packages or repositories below some directories of a workspace might have changed
+
+    Uses inotify (if the optional inotify_simple module is installed) on all directories scanned by
+    RepositoryMap and falls back to reporting a possible change every `interval` seconds otherwise,
+    leaving the actual comparison to the caller.
+    '''
+    def __init__(self, ws, directories, interval=2.0):
+        self.ws = Path(ws)
+        self.interval = interval
+        self.last = time.monotonic()
+        self.inotify = None
+        # watch descriptor -> directory and back
+        self.watches = {}
+        self.descriptors = {}
+        if inotify_simple is None:
+            print("watching the workspace by polling, install inotify_simple to use inotify", file=sys.stderr)
+            return
+        self.inotify = inotify_simple.INotify()
+        f = inotify_simple.flags
+        self.mask = f.CREATE | f.DELETE | f.CLOSE_WRITE | f.MOVED_FROM | f.MOVED_TO | f.DELETE_SELF | f.MOVE_SELF
+        try:
+            self.update(directories)
+        except OSError as e:
+            # usually fs.inotify.max_user_watches is exceeded
+            print(f"WARNING: cannot watch the workspace with inotify ({e}), polling instead", file=sys.stderr)
+            self.close()
+
+    def update(self, directories):
+        '''
+        watch exactly directories (relative to the workspace) from now on
+        '''
+        if self.inotify is None:
+            return
+        directories = set(directories)
+        for d in set(self.descriptors).difference(directories):
+            try:
+                self.inotify.rm_watch(self.descriptors[d])
+            except OSError:
+                # the directory is gone and so is its watch
+                pass
+            del self.watches[self.descriptors.pop(d)]
+        for d in directories.difference(self.descriptors):
+            try:
+                wd = self.inotify.add_watch(self.ws / d, self.mask)
+            except FileNotFoundError:
+                continue
+            self.descriptors[d] = wd
+            self.watches[wd] = d
+
+    def changed(self):
+        '''
+        whether there were relevant changes since the last call, never blocks
+        '''
+        if self.inotify is None:
+            now = time.monotonic()
+            if now - self.last < self.interval:
+                return False
+            self.last = now
+            return True
+
+        changed = False
+        for event in self.inotify.read(timeout=0):
+            if event.mask & inotify_simple.flags.IGNORED:
+                # the watch was removed along with its directory
+                d = self.watches.pop(event.wd, None)
+                if d is not None and self.descriptors.get(d) == event.wd:
+                    del self.descriptors[d]
+            if event.name in RELEVANT or event.mask & (inotify_simple.flags.ISDIR | inotify_simple.flags.DELETE_SELF | inotify_simple.flags.MOVE_SELF):
+                changed = True
+        return changed
+
+    def close(self):
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify = None
+            self.watches.clear()
+            self.descriptors.clear()
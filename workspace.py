@@ -1,14 +1,24 @@
 #!/usr/bin/env python
 # authored 2023 by Michael 'v4hn' Goerner
 
-import catkin_pkg.packages
+import argparse
+import catkin_pkg.condition
+import catkin_pkg.package
+import concurrent.futures
+import hashlib
+import json
+import numpy as np
+import profiling
+import re
 import sys
 import os
-import subprocess
 import cmd
+import xml.parsers.expat
 from collections import namedtuple
 from copy import deepcopy
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from gitinfo import read_commit
+from graph import Condensation, DependencyGraph, KINDS, csr, members, strongly_connected_components
 from pathlib import Path
 from typing import Dict, Set, List, NamedTuple
 
@@ -23,48 +33,463 @@ def get_repository(path):
         raise Exception(f"{path} is not inside a git repository")
     return p.as_posix()
 
-def get_git_info(path):
-    def call(cmd):
-        return subprocess.run(
-            cmd.split(" "),
-            stdout=subprocess.PIPE,
-            cwd=path,
-            text=True
-            ).stdout.strip()
-    version = call('git symbolic-ref --short HEAD')
-    long_ref = call('git symbolic-ref -q HEAD')
-    remote = call(f'git for-each-ref --format=%(upstream:remotename) {long_ref}')
-    url = call(f'git remote get-url {remote}')
-    if not remote:
-        print(f"ERROR: no remote found for {path}")
-    return url, version
+IGNORE_MARKERS = {'AMENT_IGNORE', 'CATKIN_IGNORE', 'COLCON_IGNORE'}
+
+class RepositoryMap:
+    '''
+    maps directories of a workspace to the root of the git repository containing them
+
+    The map is built by a single traversal of the workspace with os.scandir,
+    pruned like catkin_pkg.packages.find_package_paths (ignore markers, hidden directories, package directories).
+    Repository roots are detected by a `.git` directory or file, so nested repositories,
+    worktrees and submodules are resolved to their innermost root.
+    All paths are relative to the workspace.
+    '''
+    def __init__(self, ws):
+        self.ws = Path(ws)
+        # directory -> repository root
+        self.roots = {}
+        # directories containing a package.xml
+        self.packages = []
+
+        try:
+            enclosing = os.path.relpath(get_repository(self.ws.absolute()), self.ws.absolute())
+        except Exception:
+            enclosing = None
+
+        visited = set()
+        pending = [('.', enclosing)]
+        while pending:
+            path, root = pending.pop()
+            try:
+                with os.scandir(self.ws / path) as it:
+                    entries = list(it)
+            except OSError:
+                continue
+            names = set(e.name for e in entries)
+            if names & IGNORE_MARKERS:
+                continue
+            if '.git' in names:
+                root = path
+            self.roots[path] = root
+            if 'package.xml' in names:
+                self.packages.append(path)
+                continue
+            for e in entries:
+                if e.name.startswith('.') or not e.is_dir():
+                    continue
+                if e.is_symlink():
+                    st = e.stat()
+                    if (st.st_dev, st.st_ino) in visited:
+                        continue
+                    visited.add((st.st_dev, st.st_ino))
+                pending.append((e.name if path == '.' else f"{path}/{e.name}", root))
+        self.packages.sort()
+
+    def get_repository(self, path):
+        '''
+        returns root of git repository containing path (relative to the workspace)
+        '''
+        p = path
+        while p not in self.roots and p not in ('', '.'):
+            p = os.path.dirname(p)
+        root = self.roots.get(p or '.')
+        if root is None:
+            raise Exception(f"{self.ws / path} is not inside a git repository")
+        return root
+
+# values of the variables in package.xml conditions unless set in the environment
+CONDITION_DEFAULTS = {'ROS_VERSION': '1', 'ROS_PYTHON_VERSION': '3'}
+# variables as parsed by catkin_pkg.condition
+CONDITION_VARIABLE = re.compile(r'\$([A-Za-z0-9_]+)')
+
+def condition_context():
+    '''
+    variables package.xml conditions are evaluated with: CONDITION_DEFAULTS overridden by the environment
+    '''
+    context = dict(CONDITION_DEFAULTS)
+    context.update(os.environ)
+    return context
+
+def condition_variables(conditions, context):
+    '''
+    {variable: value} of the variables used by conditions
+    '''
+    return {v: context.get(v, '') for c in conditions for v in CONDITION_VARIABLE.findall(c)}
+
+# results of evaluate_condition by condition and values of its variables
+_conditions = {}
+
+def evaluate_condition(condition, context):
+    '''
+    cached catkin_pkg.condition.evaluate_condition
+    '''
+    variables = condition_variables([condition], context)
+    key = (condition, tuple(variables.items()))
+    if key not in _conditions:
+        _conditions[key] = catkin_pkg.condition.evaluate_condition(condition, variables)
+    return _conditions[key]
+
+class UnusualManifest(Exception):
+    '''
+    raised by extract_manifest for anything it leaves to catkin_pkg
+    '''
+    pass
+
+DEPEND_ATTRIBUTES = ('version_lt', 'version_lte', 'version_eq', 'version_gte', 'version_gt')
+
+def manifest_tags(format):
+    '''
+    {tag: allowed attributes} of the top level tags of a package.xml of format, as accepted by catkin_pkg
+    '''
+    depend = DEPEND_ATTRIBUTES + (('condition',) if format > 2 else ())
+    tags = {
+        'name': (),
+        'version': ('compatibility',),
+        'description': (),
+        'maintainer': ('email',),
+        'license': ('file',) if format > 2 else (),
+        'url': ('type',),
+        'author': ('email',),
+        'export': (),
+        }
+    depends = ['build_depend', 'buildtool_depend', 'test_depend', 'conflict', 'replace']
+    if format == 1:
+        depends += ['run_depend']
+    else:
+        depends += ['build_export_depend', 'buildtool_export_depend', 'depend', 'exec_depend', 'doc_depend']
+    tags.update((tag, depend) for tag in depends)
+    if format > 2:
+        tags.update(group_depend=('condition',), member_of_group=('condition',))
+    return tags
+
+MANIFEST_TAGS = {format: manifest_tags(format) for format in (1, 2, 3)}
+# kinds of dependencies Workspace uses declared by each tag
+DEPEND_KINDS = {
+    'build_depend': ('build',),
+    'run_depend': ('exec',),
+    'exec_depend': ('exec',),
+    'depend': ('build', 'exec'),
+    'test_depend': ('test',),
+    }
+# the lists of catkin_pkg.package.Package each tag adds to
+DEPEND_LISTS = {
+    'build_depend': ('build_depends',),
+    'buildtool_depend': ('buildtool_depends',),
+    'build_export_depend': ('build_export_depends',),
+    'buildtool_export_depend': ('buildtool_export_depends',),
+    'exec_depend': ('exec_depends',),
+    'run_depend': ('build_export_depends', 'exec_depends'),
+    'depend': ('build_depends', 'build_export_depends', 'exec_depends'),
+    'test_depend': ('test_depends',),
+    'doc_depend': ('doc_depends',),
+    'conflict': ('conflicts',),
+    'replace': ('replaces',),
+    }
+# pairs of tags catkin_pkg reports as redundant when they declare the same dependency
+REDUNDANT = {
+    1: [('test_depend', 'build_depend'), ('test_depend', 'run_depend')],
+    2: [('depend', 'build_depend'), ('depend', 'build_export_depend'), ('depend', 'exec_depend')],
+    }
+REDUNDANT[3] = REDUNDANT[2]
+
+def extract_manifest(filename, data, context):
+    '''
+    returns the same as catkin_manifest, streaming through the xml with expat instead of building catkin_pkg's model
+
+    The structure catkin_pkg checks while parsing is validated here (known tags and attributes, required tags,
+    no nested elements), the contents are validated by catkin_pkg's Package.validate on the extracted fields.
+    Raises UnusualManifest for anything out of the ordinary like invalid xml, document type declarations,
+    metapackages, groups or dependencies declared twice by the same or redundant tags, catkin_pkg decides about these.
+    '''
+    parser = xml.parsers.expat.ParserCreate()
+    # names of the open elements
+    stack = []
+    text = []
+    attributes = {}
+    counts = {}
+    format = None
+    tags = None
+    # text and attributes of the top level elements by tag
+    fields = {}
+    # nested elements of the description
+    markup = False
+
+    def unusual(*args):
+        raise UnusualManifest()
+
+    def start(tag, attrs):
+        nonlocal format, tags, attributes, markup
+        if not stack:
+            if tag != 'package' or set(attrs).difference(['format']):
+                unusual()
+            try:
+                format = int(attrs.get('format', 1))
+            except ValueError:
+                unusual()
+            tags = MANIFEST_TAGS.get(format) or unusual()
+        elif len(stack) == 1:
+            allowed = tags.get(tag)
+            if allowed is None or set(attrs).difference(allowed) or tag in ('group_depend', 'member_of_group'):
+                unusual()
+            counts[tag] = counts.get(tag, 0) + 1
+            attributes = attrs
+            text.clear()
+        elif stack[1] == 'description':
+            markup = True
+        elif stack[1] == 'export':
+            if len(stack) == 2 and tag == 'metapackage':
+                unusual()
+        else:
+            unusual()
+        stack.append(tag)
+
+    def end(tag):
+        stack.pop()
+        if len(stack) == 1:
+            fields.setdefault(tag, []).append((''.join(text).strip(), attributes))
+
+    def characters(data):
+        if len(stack) >= 2 and stack[1] != 'export':
+            text.append(data)
+
+    parser.StartElementHandler = start
+    parser.EndElementHandler = end
+    parser.CharacterDataHandler = characters
+    parser.StartDoctypeDeclHandler = unusual
+    parser.EntityDeclHandler = unusual
+    try:
+        parser.Parse(data, True)
+    except xml.parsers.expat.ExpatError:
+        unusual()
+
+    if any(counts.get(t, 0) != 1 for t in ('name', 'version', 'description')):
+        unusual()
+    declared = {tag: [value for value, _ in fields.get(tag, [])] for tag in DEPEND_LISTS}
+    for tag, values in declared.items():
+        if len(set(values)) != len(values):
+            unusual()
+    for a, b in REDUNDANT[format]:
+        if set(declared[a]).intersection(declared[b]):
+            unusual()
+
+    (name, _), = fields['name']
+    (version, version_attributes), = fields['version']
+    (description, _), = fields['description']
+    lists = {}
+    for tag, entries in fields.items():
+        for l in DEPEND_LISTS.get(tag, ()):
+            lists.setdefault(l, []).extend(catkin_pkg.package.Dependency(value) for value, _ in entries)
+    package = catkin_pkg.package.Package(
+        filename=filename,
+        package_format=format,
+        name=name,
+        version=version,
+        version_compatibility=version_attributes.get('compatibility'),
+        description=description or markup,
+        maintainers=[catkin_pkg.package.Person(v, a.get('email')) for v, a in fields.get('maintainer', [])],
+        authors=[catkin_pkg.package.Person(v, a.get('email')) for v, a in fields.get('author', [])],
+        licenses=[v for v, _ in fields.get('license', [])],
+        **lists)
+    package.validate()
+
+    depends = {kind: set() for kind in ('build', 'exec', 'test')}
+    conditions = []
+    for tag, kinds in DEPEND_KINDS.items():
+        for value, a in fields.get(tag, []):
+            condition = a.get('condition')
+            if condition is not None:
+                conditions.append(condition)
+                try:
+                    if not evaluate_condition(condition, context):
+                        continue
+                except ValueError:
+                    # let catkin_pkg report the condition it cannot parse
+                    unusual()
+            for kind in kinds:
+                depends[kind].add(value)
+    return {
+        'name': name,
+        'build_depends': sorted(depends['build']),
+        'exec_depends': sorted(depends['exec']),
+        'test_depends': sorted(depends['test']),
+        'variables': condition_variables(conditions, context),
+        }
+
+def catkin_manifest(filename, data, context):
+    '''
+    returns the fields of a package.xml used by Workspace as a json-serializable dict,
+    leaving out dependencies whose condition is false in context,
+    and the values of the variables these conditions depend on
+    '''
+    catpkg = catkin_pkg.package.parse_package_string(data.decode('utf-8'), filename=filename)
+    catpkg.evaluate_conditions(context)
+    def names(depends):
+        return sorted(set([d.name for d in depends if d.evaluated_condition is not False]))
+    conditions = [d.condition for kind in KINDS for d in catpkg[f'{kind}_depends'] if d.condition is not None]
+    return {
+        'name': catpkg['name'],
+        'build_depends': names(catpkg['build_depends']),
+        'exec_depends': names(catpkg['exec_depends']),
+        'test_depends': names(catpkg['test_depends']),
+        'variables': condition_variables(conditions, context),
+        }
+
+def parse_manifest(filename, data, context=None):
+    '''
+    returns catkin_manifest, extracted by the fast path if possible
+    context: variables of the conditions (default: condition_context())
+    '''
+    context = context or condition_context()
+    try:
+        return extract_manifest(filename, data, context)
+    except UnusualManifest:
+        return catkin_manifest(filename, data, context)
+
+def load_manifest(filename):
+    '''
+    reads and parses the package.xml at filename, adding the content hash to the result
+    '''
+    with open(filename, 'rb') as f:
+        data = f.read()
+    entry = parse_manifest(filename, data)
+    entry['hash'] = hashlib.sha256(data).hexdigest()
+    return entry
 
 @dataclass
 class Package:#(NamedTuple):
     name: str
     path: str
     repository: str
+
+    # node in Workspace.package_graph holding the dependencies
+    graph: DependencyGraph = field(default=None, repr=False, compare=False)
+    id: int = field(default=-1, repr=False, compare=False)
+
     # these are packages
-    build_depends: Set[str]
-    exec_depends: Set[str]
-    test_depends: Set[str]
+    @property
+    def build_depends(self) -> Set[str]:
+        return self.graph.depends(self.id, 'build')
+
+    @property
+    def exec_depends(self) -> Set[str]:
+        return self.graph.depends(self.id, 'exec')
+
+    @property
+    def test_depends(self) -> Set[str]:
+        return self.graph.depends(self.id, 'test')
 
 @dataclass
 class Repository:#(NamedTuple):
     name: str
     path: str
-    packages: Set[Package]
+    packages: List[Package]
 
-    # these are repositories
-    build_depends: Set[str]
-    exec_depends: Set[str]
-    test_depends: Set[str]
+    # node in Workspace.repository_graph holding the dependencies
+    graph: DependencyGraph = field(default=None, repr=False, compare=False)
+    id: int = field(default=-1, repr=False, compare=False)
 
     # these are repositories with cyclic build/test dependencies
     # such dependencies are not allowed by ROS on the package graph, but can arise in the repository groups
-    # THEY ARE EXPLICITLY EXCLUDED ABOVE
+    # THEY ARE EXPLICITLY EXCLUDED BELOW
     bonded: Set[str] = None
 
+    # these are repositories
+    @property
+    def build_depends(self) -> Set[str]:
+        return self.graph.depends(self.id, 'build')
+
+    @property
+    def exec_depends(self) -> Set[str]:
+        return self.graph.depends(self.id, 'exec')
+
+    @property
+    def test_depends(self) -> Set[str]:
+        return self.graph.depends(self.id, 'test')
+
+class WorkspaceIndex:
+    '''
+    on-disk cache of parsed package.xml files
+
+    Entries are keyed by package path and validated by mtime/size first and content hash second.
+    The commit checked out in each repository is recorded as well and a different commit forces
+    the hash check for all manifests of the repository.
+    Entries also record the variables their conditions read and are parsed again when one of them changes.
+    '''
+    VERSION = 4
+    FILENAME = '.workspace_index.json'
+
+    def __init__(self, filename):
+        self.filename = Path(filename)
+        self.manifests = {}
+        self.heads = {}
+        self.dirty = False
+        self.context = condition_context()
+        try:
+            with open(self.filename) as f:
+                index = json.load(f)
+            if index.get('version') == self.VERSION:
+                self.manifests = index['manifests']
+                self.heads = index['heads']
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def lookup(self, path, filename, repository, head):
+        '''
+        returns cached entry for package path if it is still valid for the manifest at filename
+        in repository, which has commit head checked out
+        '''
+        entry = self.manifests.get(path)
+        if entry is None or any(self.context.get(k, '') != v for k, v in entry['variables'].items()):
+            return None
+        if entry['repository'] != repository:
+            # repositories are detected anew on every run, e.g. a nested repository was cloned
+            entry['repository'] = repository
+            self.dirty = True
+        st = os.stat(filename)
+        if entry['mtime'] == st.st_mtime_ns and entry['size'] == st.st_size and self.heads.get(repository) == head:
+            return entry
+        with open(filename, 'rb') as f:
+            data = f.read()
+        if entry['hash'] != hashlib.sha256(data).hexdigest():
+            return None
+        entry['mtime'] = st.st_mtime_ns
+        entry['size'] = st.st_size
+        self.dirty = True
+        return entry
+
+    def update(self, path, filename, entry):
+        st = os.stat(filename)
+        entry['mtime'] = st.st_mtime_ns
+        entry['size'] = st.st_size
+        self.manifests[path] = entry
+        self.dirty = True
+
+    def set_heads(self, heads):
+        if heads != self.heads:
+            self.heads = heads
+            self.dirty = True
+
+    def prune(self, paths):
+        '''
+        drop entries of packages which are not in paths anymore
+        '''
+        for path in set(self.manifests).difference(paths):
+            del self.manifests[path]
+            self.dirty = True
+
+    def save(self):
+        if not self.dirty:
+            return
+        tmp = self.filename.with_name(self.filename.name + '.tmp')
+        try:
+            with open(tmp, 'w') as f:
+                json.dump({'version': self.VERSION, 'manifests': self.manifests, 'heads': self.heads}, f)
+            os.replace(tmp, self.filename)
+        except OSError as e:
+            print(f"WARNING: could not write workspace index {self.filename}: {e}", file=sys.stderr)
+        self.dirty = False
+
 class Workspace:
     @property
     def repositories(self):
@@ -74,101 +499,318 @@ class Workspace:
     def packages(self):
         return self._pkgs
 
-    def __init__(self, ws):
+    def __init__(self, ws, index=True, jobs=1):
+        '''
+        index: cache parsed manifests in WorkspaceIndex.FILENAME inside ws (True),
+               at the given path (str) or not at all (False)
+        jobs: number of processes used to parse manifests missing from the index (0 to use all cores)
+        '''
         if ws.endswith('/'):
             ws = ws[:len(ws)-1]
         self.ws = Path(ws)
         self.cut_prefix = 0 if ws == "." else len(ws)+1
 
-        # index of all packages in workspace
-        self._pkgs = {
-            catpkg['name']: Package(
-                name=catpkg['name'],
-                path=path,
-                repository=get_repository(self.ws/path)[self.cut_prefix:],
-                build_depends=set([d.name for d in catpkg['build_depends']]),
-                exec_depends=set([d.name for d in catpkg['exec_depends']]),
-                test_depends=set([d.name for d in catpkg['test_depends']]),
-                )
-            for (path, catpkg) in catkin_pkg.packages.find_packages(ws).items()
-        }
+        if index is True:
+            index = self.ws / WorkspaceIndex.FILENAME
+        self.index = WorkspaceIndex(index) if index else None
+        self.jobs = jobs or os.cpu_count()
 
-        # index of all repositories in workspace
-        self._repos= {}
-        repository_names = set([p.repository for p in self._pkgs.values()])
-        for name in repository_names:
-            pkgs = [p for p in self._pkgs.values() if p.repository == name]
-            self._repos[name] = Repository(
-                name=name,
-                path=repository_names,
-                packages=[pkg for pkg in self._pkgs.values() if pkg.repository == name],
-                build_depends=set([self._pkgs[d].repository for pkg in pkgs for d in pkg.build_depends if d in self._pkgs]).difference([name]),
-                exec_depends=set([self._pkgs[d].repository for pkg in pkgs for d in pkg.exec_depends if d in self._pkgs]).difference([name]),
-                test_depends=set([self._pkgs[d].repository for pkg in pkgs for d in pkg.test_depends if d in self._pkgs]).difference([name]),
-                )
-
-        # find cyclic build/test dependencies
-        for repo in self._repos.values():
-            while True:
-                cycle = self.detect_cycle(repo)
-                if not cycle:
-                    break
-                bonded = set(cycle)
-                for cyc_repo in cycle:
-                    cyc_repo_bonds = self._repos[cyc_repo].bonded
-                    if cyc_repo_bonds:
-                        bonded.update(cyc_repo_bonds)
-
-                for cyc_repo in bonded:
-                    self._repos[cyc_repo].bonded = bonded
-
-                # drop the cyclic dependencies in build and test dependencies
-                for cyc_repo in bonded:
-                    self._repos[cyc_repo].build_depends.difference_update(bonded)
-                    self._repos[cyc_repo].exec_depends.difference_update(bonded)
-                    self._repos[cyc_repo].test_depends.difference_update(bonded)
-
-    def detect_cycle(self, rep, visited= None):
-        if visited is None:
-            visited = []
-        visited.append(rep.name)
-        deps = rep.build_depends.union(rep.test_depends, rep.exec_depends)
-        for d in deps:
-            try:
-                i = visited.index(d)
-                # cycle found
-                return set(visited[i:])
-            except ValueError:
-                pass
-            if d in self._repos:
-                cycle = self.detect_cycle(self._repos[d], visited)
-                if cycle:
-                    return cycle
-        visited.pop()
+        # single traversal to find packages and their repositories
+        with profiling.span('scan'):
+            self.repository_map = RepositoryMap(self.ws)
+
+        with profiling.span('manifests'):
+            # index of all packages in workspace
+            manifests = self.load_manifests(self.repository_map.packages)
+            names = {}
+            for path, manifest in manifests.items():
+                if manifest['name'] in names:
+                    raise RuntimeError(f"multiple packages named '{manifest['name']}' found: {names[manifest['name']]}, {path}")
+                names[manifest['name']] = path
+
+        with profiling.span('package graph'):
+            # package graph, dependencies outside of the workspace are interned after the packages
+            node_ids = {name: i for i, name in enumerate(names)}
+            node_names = list(names)
+            edges = {kind: ([], []) for kind in KINDS}
+            for i, manifest in enumerate(manifests.values()):
+                for kind in KINDS:
+                    src, dst = edges[kind]
+                    for d in manifest[f'{kind}_depends']:
+                        j = node_ids.get(d)
+                        if j is None:
+                            j = node_ids[d] = len(node_names)
+                            node_names.append(d)
+                        src.append(i)
+                        dst.append(j)
+            self.package_graph = DependencyGraph(node_names, edges)
+
+        with profiling.span('repository graph'):
+            # repository graph, induced by dependencies between packages of different repositories
+            repository_ids = {}
+            package_repository = np.array([repository_ids.setdefault(m['repository'], len(repository_ids)) for m in manifests.values()], dtype=np.int64)
+            repository_edges = {}
+            for kind in KINDS:
+                src, dst = (np.asarray(a, dtype=np.int64) for a in edges[kind])
+                internal = dst < len(names)
+                src, dst = package_repository[src[internal]], package_repository[dst[internal]]
+                pairs = np.unique((src * len(repository_ids) + dst)[src != dst])
+                repository_edges[kind] = (pairs // len(repository_ids), pairs % len(repository_ids))
+            self.repository_graph = DependencyGraph(list(repository_ids), repository_edges)
+            # the same graph keeping the dependencies between bonded repositories, which are removed
+            # from repository_graph below, so that transitive queries do not stop at bonded partners
+            self.repository_dependencies = DependencyGraph(list(repository_ids), repository_edges)
+
+            self._pkgs = {}
+            packages = {name: [] for name in repository_ids}
+            for i, (path, manifest) in enumerate(manifests.items()):
+                pkg = Package(
+                    name=manifest['name'],
+                    path=path,
+                    repository=manifest['repository'],
+                    graph=self.package_graph,
+                    id=i,
+                    )
+                self._pkgs[pkg.name] = pkg
+                packages[pkg.repository].append(pkg)
+
+            # index of all repositories in workspace
+            self._repos = {
+                name: Repository(
+                    name=name,
+                    path=name,
+                    packages=packages[name],
+                    graph=self.repository_graph,
+                    id=i,
+                    )
+                for name, i in repository_ids.items()
+            }
+
+        with profiling.span('condensation'):
+            # find cyclic build/test dependencies
+            # all repositories of a strongly connected component are bonded and have to be built together
+            self.condensation = Condensation(self.repository_graph)
+            for component in self.condensation.components:
+                if len(component) < 2:
+                    continue
+                bonded = set(self.repository_graph.names[i] for i in component)
+                for i in component:
+                    self._repos[self.repository_graph.names[i]].bonded = bonded
+                    # drop the cyclic dependencies in build and test dependencies
+                    for kind in KINDS:
+                        self.repository_graph.remove_edges(i, kind, component)
+
+    def group(self, c):
+        '''
+        returns the repositories of component c of the condensation which are still in the workspace
+        '''
+        names = self.repository_graph.names
+        return [self._repos[names[i]] for i in self.condensation.components[c] if names[i] in self._repos]
+
+    def load_manifests(self, paths):
+        '''
+        returns parsed manifests for all package paths, reusing valid entries of the index
+        '''
+        manifests = {}
+        heads = {}
+        missing = []
+        for path in paths:
+            filename = (self.ws / path / 'package.xml').as_posix()
+            entry = None
+            if self.index:
+                repository = self.repository_map.get_repository(path)
+                if repository not in heads:
+                    heads[repository] = read_commit(self.ws / repository)
+                entry = self.index.lookup(path, filename, repository, heads[repository])
+            if entry is None:
+                missing.append((path, filename))
+            manifests[path] = entry
+
+        with profiling.span('parse', manifests=len(missing)):
+            parsed = self.parse_manifests([filename for _, filename in missing])
+        for (path, filename), entry in zip(missing, parsed):
+            entry['repository'] = self.repository_map.get_repository(path)
+            if self.index:
+                self.index.update(path, filename, entry)
+            manifests[path] = entry
+
+        if self.index:
+            for entry in manifests.values():
+                if entry['repository'] not in heads:
+                    heads[entry['repository']] = read_commit(self.ws / entry['repository'])
+            self.index.prune(manifests)
+            self.index.set_heads(heads)
+            self.index.save()
+        return manifests
+
+    def parse_manifests(self, filenames):
+        '''
+        returns load_manifest results for all filenames in order, using a process pool for jobs > 1
+        '''
+        if self.jobs <= 1 or len(filenames) < 2 * self.jobs:
+            return [load_manifest(f) for f in filenames]
+        chunksize = max(1, len(filenames) // (4 * self.jobs))
+        try:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=self.jobs) as pool:
+                return list(pool.map(load_manifest, filenames, chunksize=chunksize))
+        except OSError:
+            # multiprocessing is not available in some chroot environments
+            return [load_manifest(f) for f in filenames]
+
+    def resolve(self, names):
+        '''
+        returns the repositories of names, which may be repository or package names
+        '''
+        repositories = set()
+        for name in names:
+            if name in self._repos:
+                repositories.add(name)
+            elif name in self._pkgs:
+                repositories.add(self._pkgs[name].repository)
+            else:
+                raise KeyError(f"'{name}' is neither a repository nor a package in the workspace")
+        return repositories
+
+    def select(self, up_to=(), above=(), repositories=()):
+        '''
+        returns the names of the repositories selected like colcon's --packages-up-to/--packages-above/--packages-select
+
+        up_to: these and all their (transitive) dependencies
+        above: these and all repositories (transitively) depending on them
+        repositories: exactly these
+        All arguments may name repositories or packages, bonded repositories are always selected together.
+        '''
+        # the dependencies within bonded repositories are removed from the repository graph,
+        # so the closures are taken over the components of the condensation
+        cond = self.condensation
+        def components(names):
+            return set(cond.component[self._repos[r].id] for r in self.resolve(names))
+        def closure(seeds, neighbors):
+            seen = set(seeds)
+            pending = list(seen)
+            while pending:
+                for d in neighbors(pending.pop()).tolist():
+                    if d not in seen:
+                        seen.add(d)
+                        pending.append(d)
+            return seen
+        selected = closure(components(up_to), cond.dependencies)
+        selected |= closure(components(above), cond.dependents)
+        selected |= components(repositories)
+        return set(r.name for c in selected for r in self.group(c))
+
+    def restrict(self, repositories):
+        '''
+        drop all repositories but the given ones, dependencies on dropped repositories are considered available
+        '''
+        for r in set(self._repos).difference(repositories):
+            self.drop_repository(r)
+
+    def detect_cycle(self, rep):
+        '''
+        returns the names of the repositories of a dependency cycle reachable from rep or an empty set
+        '''
+        src, dst = self.repository_graph.edges()
+        indptr, indices, _ = csr(len(self.repository_graph), src, dst)
+        for component in strongly_connected_components(indptr.tolist(), indices.tolist(), [rep.id]):
+            if len(component) > 1:
+                return set(self.repository_graph.names[i] for i in component)
         return set()
 
+    def node(self, name, repositories=False):
+        '''
+        returns (graph, id) of package name or of repository name if repositories is set
+        Dependencies outside of the workspace can be queried as packages.
+        '''
+        graph = self.repository_dependencies if repositories else self.package_graph
+        i = graph.ids.get(name)
+        if i is None or not graph.alive[i]:
+            raise KeyError(f"'{name}' is not a {'repository' if repositories else 'package'} in the workspace")
+        return graph, i
 
+    def dependencies(self, name, kinds=KINDS, reverse=False, repositories=False) -> List[str]:
+        '''
+        returns the names of everything name (transitively) depends on, or which depends on name if reverse is set
+        Transitive closures are built once per kinds and reused until the workspace changes.
+        '''
+        graph, i = self.node(name, repositories)
+        reachability = graph.reachability(kinds)
+        closure = reachability.ancestors if reverse else reachability.descendants
+        return [graph.names[j] for j in members(closure[i] & ~(1 << i))]
 
+    def longest_chain(self, name, kinds=KINDS, repositories=False) -> List[str]:
+        '''
+        returns a longest chain of dependencies starting at name
+        '''
+        graph, i = self.node(name, repositories)
+        return [graph.names[j] for j in graph.longest_chain(i, kinds)]
+
+    def why(self, name, dependency, kinds=KINDS, repositories=False):
+        '''
+        returns a shortest chain of dependencies from name to dependency or None if name does not depend on it
+        '''
+        graph, i = self.node(name, repositories)
+        _, j = self.node(dependency, repositories)
+        path = graph.path(i, j, kinds)
+        return path and [graph.names[k] for k in path]
+
+    def query(self, line, kinds=KINDS, repositories=False):
+        '''
+        answers a query in the form of
+        `deps <name>`, `rdeps <name>`, `chain <name>` or `why <name> <dependency>`
+        '''
+        command, *args = line.split()
+        if command in ('deps', 'rdeps') and len(args) == 1:
+            return ' '.join(self.dependencies(args[0], kinds, command == 'rdeps', repositories))
+        if command == 'chain' and len(args) == 1:
+            return ' -> '.join(self.longest_chain(args[0], kinds, repositories))
+        if command == 'why' and len(args) == 2:
+            path = self.why(*args, kinds, repositories)
+            return ' -> '.join(path) if path else f"{args[0]} does not depend on {args[1]}"
+        raise ValueError(f"unknown query '{line}'")
 
     def drop_repository(self, repository):
+        '''
+        remove repository and its packages from the workspace and from all dependencies
+        '''
         for p in self._repos[repository].packages:
+            self.package_graph.remove_node(p.id)
             del self._pkgs[p.name]
-            # remove pkg from other pkg dependencies
-            for p in self._pkgs.values():
-                p.build_depends.difference_update([p.name])
-                p.exec_depends.difference_update([p.name])
-                p.test_depends.difference_update([p.name])
 
+        self.repository_graph.remove_node(self._repos[repository].id)
+        self.repository_dependencies.remove_node(self._repos[repository].id)
         del self._repos[repository]
-        # remove repository from other repositories dependencies
-        for r in self._repos.values():
-            r.build_depends.difference_update([repository])
-            r.exec_depends.difference_update([repository])
-            r.test_depends.difference_update([repository])
 
 if __name__ == '__main__':
-    ws = Workspace(sys.argv[1] if len(sys.argv) > 1 else ".")
+    parser = argparse.ArgumentParser(description="print repository build dependencies of a workspace in dot format or answer dependency queries")
+    parser.add_argument('workspace', nargs='?', default='.')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help="processes used to parse package.xml files (0: all cores)")
+    parser.add_argument('-q', '--query', action='append', default=[],
+                        help="`deps <name>`, `rdeps <name>`, `chain <name>` or `why <name> <dependency>`, may be repeated")
+    parser.add_argument('--queries', type=argparse.FileType('r'), help="file with one query per line ('-' for stdin)")
+    parser.add_argument('--kinds', default=','.join(KINDS), help="comma separated dependency kinds the queries follow")
+    parser.add_argument('--repositories', action='store_true', help="query the repository graph instead of the package graph")
+    args = parser.parse_args()
+
+    ws = Workspace(args.workspace, jobs=args.jobs)
+
+    queries = args.query + ([line.strip() for line in args.queries if line.strip()] if args.queries else [])
+    if queries:
+        kinds = args.kinds.split(',')
+        if not set(kinds).issubset(KINDS):
+            parser.error(f"--kinds has to be a subset of {','.join(KINDS)}")
+        for q in queries:
+            try:
+                print(f"{q}: {ws.query(q, kinds, args.repositories)}")
+            except (KeyError, ValueError) as e:
+                print(f"{q}: ERROR: {e.args[0]}")
+        sys.exit(0)
+
     print("digraph ros {")
+    for c in range(len(ws.condensation)):
+        group = ws.group(c)
+        if len(group) > 1:
+            print(f"subgraph cluster_{c} {{ label=\"bonded\"; {' '.join(f'{r.name};' for r in group)} }}")
     for r in ws.repositories.values():
         for d in r.build_depends:
             print(f"{r.name} -> {d};")